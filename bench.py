@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import contextlib
+import gc
+import multiprocessing
+import random
+import threading
+import time
+import tracemalloc
+
+from code import Cache, CacheList, CompactCacheList, CompressedCacheList, ContentItem
+from server import CacheClient, CacheServer
+from shm import SharedCache
+
+
+def _timed(ops, fn):
+  start = time.perf_counter()  #time the whole batch so the timer cost doesn't swamp a single op
+  for arg in ops:
+    fn(arg)
+  return (time.perf_counter() - start) / len(ops) * 1e9  #nanoseconds per op
+
+
+def bench_index(sizes=(1_000, 10_000, 100_000, 1_000_000), ops=20_000, seed=0):
+  #fill a CacheList with n items and time hit, miss, promote and insert+evict, the numbers should stay flat as n grows
+  rng = random.Random(seed)
+  rows = []
+  for n in sizes:
+    lst = CacheList(n)
+    for cid in range(n):
+      lst.put(ContentItem(cid, 1, "bench", cid), 'lru')
+
+    hits = [rng.randrange(n) for _ in range(ops)]
+    misses = [n + rng.randrange(n) for _ in range(ops)]
+    row = {'items': n}
+    row['hit'] = _timed(hits, lst.get)
+    row['miss'] = _timed(misses, lst.get)
+    row['promote'] = _timed(hits, lambda cid: lst.update(cid, lst.index[cid].value))
+    fresh = iter(range(2 * n, 2 * n + ops))
+    row['insert+evict'] = _timed(range(ops), lambda _: lst.put(ContentItem(next(fresh), 1, "bench", None), 'lru'))
+    rows.append(row)
+  return rows
+
+
+def _run_threads(count, target):
+  workers = [threading.Thread(target=target, args=(seed,)) for seed in range(count)]
+  start = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return time.perf_counter() - start
+
+
+def bench_threads(threads=(1, 2, 4, 8), ops=50_000, shards=8, keys=100_000):
+  #ops/sec for a 90% read / 10% write zipf-ish mix, lock per shard against one lock around the whole cache
+  rows = []
+  for count in threads:
+    row = {'threads': count}
+    for name in ('global lock', 'striped'):
+      cache = Cache(keys // shards, shards=shards, concurrent=(name == 'striped'))
+      lock = threading.Lock() if name == 'global lock' else contextlib.nullcontext()
+
+      def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(ops // count):
+          cid = int(rng.paretovariate(1.1)) % keys
+          item = ContentItem(cid, 1, "bench", cid)
+          with lock:
+            if rng.random() < 0.9:
+              cache[item]
+            else:
+              cache.insert(item)
+
+      row[name] = ops / _run_threads(count, worker)
+    rows.append(row)
+  return rows
+
+
+def bench_batch(items=100_000, batch=1_000, shards=8, mode='partition'):
+  #seconds to warm and then query the same items one at a time against insert_many/get_many
+  contents = [ContentItem(cid, 1, "bench", cid) for cid in range(items)]
+  rows = []
+  for name in ('per item', 'batched'):
+    cache = Cache(items // shards // 2, mode=mode, shards=shards)  #half of it fits so the inserts keep evicting
+    start = time.perf_counter()
+    if name == 'per item':
+      for content in contents:
+        cache.insert(content)
+    else:
+      for offset in range(0, items, batch):
+        cache.insert_many(contents[offset:offset + batch])
+    inserted = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if name == 'per item':
+      for content in contents:
+        cache[content]
+    else:
+      for offset in range(0, items, batch):
+        cache.get_many(contents[offset:offset + batch])
+    looked_up = time.perf_counter() - start
+    rows.append({'mode': name, 'insert s': inserted, 'get s': looked_up})
+  return rows
+
+
+def bench_memory(sizes=(10_000, 100_000, 1_000_000)):
+  #bytes per entry held by a full list, ContentItem included, and the objects the gc has to walk per entry
+  rows = []
+  for n in sizes:
+    for name, make in (('nodes', lambda: CacheList(n)), ('compact', lambda: CompactCacheList(n, slots=n))):
+      gc.collect()
+      tracked = len(gc.get_objects())
+      tracemalloc.start()
+      lst = make()
+      for cid in range(n):
+        lst.put(ContentItem(cid, 1, "bench", None), 'lru')
+      used = tracemalloc.get_traced_memory()[0]
+      tracemalloc.stop()
+      rows.append({'storage': name, 'items': n, 'bytes/entry': used / n, 'gc objects/entry': (len(gc.get_objects()) - tracked) / n})
+      del lst
+  return rows
+
+
+def _page(cid, rng):
+  #an html page put together from a small vocabulary, about as repetitive as real markup
+  words = ['cache', 'level', 'content', 'header', 'policy', 'evict', 'shard', 'node', 'psu', 'cmpsc132']
+  rows = ''.join(f"<tr><td class='cell'>{rng.choice(words)}</td><td>{rng.randrange(1000)}</td></tr>" for _ in range(40))
+  return f"<html><head><title>page {cid}</title></head><body><table>{rows}</table></body></html>"
+
+
+def bench_compression(budget=1_000_000, pages=5_000, ops=20_000, seed=0):
+  #how many html pages a list of budget bytes holds per codec, and what a hit costs with and without the hot set
+  rng = random.Random(seed)
+  contents = [ContentItem(cid, 0, "Content-Type: 2", _page(cid, rng)) for cid in range(pages)]
+  for content in contents:
+    content.size = len(content.content)
+  rows = []
+  for codec in (None, 'zlib', 'lzma'):
+    lst = CacheList(budget) if codec is None else CompressedCacheList(budget, codec=codec, hotItems=0)
+    start = time.perf_counter()
+    for content in contents:
+      lst.put(content)
+    inserted = (time.perf_counter() - start) / pages * 1e9
+    held = [content.cid for content in lst]
+    cold = _timed([rng.choice(held) for _ in range(ops)], lambda cid: lst.get(cid).value.content)
+    lst.hotItems = 32 if codec is not None else 0
+    hot = _timed([held[rng.randrange(16)] for _ in range(ops)], lambda cid: lst.get(cid).value.content)  #16 pages read over and over fit the hot set
+    rows.append({'codec': codec or 'none', 'items': len(held), 'insert ns': inserted, 'cold hit ns': cold, 'hot hit ns': hot})
+  return rows
+
+
+def _process_worker(cache, budget, ops, keys, seed, results):
+  #read through: look the cid up and insert it on a miss, cache is None for a private Cache per process
+  private = cache is None
+  if private:
+    cache = Cache(budget // 3)  #three partition lists, the same budget the shared cache gets in total
+  rng = random.Random(seed)
+  hits = 0
+  start = time.perf_counter()
+  for _ in range(ops):
+    cid = int(rng.paretovariate(1.1)) % keys
+    item = ContentItem(cid, 100, "bench", "%099d" % cid)
+    if cache[item] == 'Cache miss!':
+      cache.insert(item)
+    else:
+      hits += 1
+  results.put((hits, time.perf_counter() - start))
+  if not private:
+    cache.close()
+
+
+def bench_processes(processes=(1, 2, 4, 8), ops=50_000, keys=100_000, budget=1_000_000, shards=8):
+  #ops/sec over every worker and the hit ratio, a private Cache in each process against one SharedCache they all use
+  context = multiprocessing.get_context()
+  rows = []
+  for count in processes:
+    row = {'processes': count}
+    for name in ('private', 'shared'):
+      cache = SharedCache(budget // shards, shards=shards, context=context.get_start_method()) if name == 'shared' else None
+      results = context.Queue()
+      workers = [context.Process(target=_process_worker, args=(cache, budget, ops // count, keys, seed, results)) for seed in range(count)]
+      start = time.perf_counter()
+      for worker in workers:
+        worker.start()
+      finished = [results.get() for _ in workers]
+      for worker in workers:
+        worker.join()
+      elapsed = time.perf_counter() - start
+      if cache is not None:
+        cache.unlink()
+      row[f'{name} ops/s'] = (ops // count) * count / elapsed
+      row[f'{name} hit'] = sum(hits for hits, _ in finished) / ((ops // count) * count)
+    rows.append(row)
+  return rows
+
+
+def bench_watermarks(items=200_000, capacity=20_000, shards=4, seed=0, batches=(16, 256, 1024)):
+  #insert latency under a steady stream of new content, evicting inline against a background evictor taking batches items per lock hold
+  rng = random.Random(seed)
+  contents = [ContentItem(cid, rng.choice((1, 1, 1, 2, 4, 64)), "bench", None) for cid in range(items)]  #the odd big item has to push out many small ones
+  rows = []
+  for name, watermarks, batch in [('inline', None, None)] + [(f'watermarks/{batch}', (0.9, 0.7), batch) for batch in batches]:
+    cache = Cache(capacity, mode='exclusive', shards=shards, concurrent=True, watermarks=watermarks, reclaimBatch=batch)
+    latencies = []
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for content in contents:
+      began = clock()
+      cache.insert(content)
+      latencies.append(clock() - began)
+    elapsed = time.perf_counter() - start
+    cache.close()
+    latencies.sort()
+    rows.append({'eviction': name, 'inserts/s': items / elapsed, 'p50 ns': latencies[items // 2], 'p99 ns': latencies[int(items * 0.99)], 'p999 ns': latencies[int(items * 0.999)]})
+  return rows
+
+
+def _server_process(ports, capacity):
+  async def run():
+    server = await CacheServer(Cache(capacity, mode='exclusive', shards=8)).start('127.0.0.1', 0)
+    ports.put(server.port)
+    await server.serve_forever()
+  asyncio.run(run())
+
+
+async def _load(port, concurrency, ops, keys, batch, seed):
+  client = CacheClient('127.0.0.1', port, pool=min(concurrency, 16))
+  latencies = []
+
+  async def worker(number):
+    rng = random.Random(seed + number)
+    for _ in range(ops // concurrency):
+      cids = [str(int(rng.paretovariate(1.1)) % keys) for _ in range(batch)]
+      start = time.perf_counter()
+      if rng.random() < 0.9:
+        await client.get_many(cids)
+      else:
+        await client.set_many({cid: b'x' * 100 for cid in cids})
+      latencies.append(time.perf_counter() - start)
+
+  start = time.perf_counter()
+  await asyncio.gather(*[worker(number) for number in range(concurrency)])
+  elapsed = time.perf_counter() - start
+  await client.close()
+  latencies.sort()
+  return len(latencies) * batch / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def bench_server(concurrency=(1, 4, 16, 64), ops=20_000, keys=100_000, batches=(1, 10)):
+  #keys/sec and request latency against a CacheServer in its own process, 90% get and 10% set, as more requests are in flight
+  context = multiprocessing.get_context()
+  ports = context.Queue()
+  server = context.Process(target=_server_process, args=(ports, 10_000_000), daemon=True)
+  server.start()
+  port = ports.get()
+  rows = []
+  try:
+    for batch in batches:
+      for count in concurrency:
+        rate, p50, p99 = asyncio.run(_load(port, count, ops // batch, keys, batch, count))
+        rows.append({'keys/request': batch, 'in flight': count, 'keys/s': rate, 'p50 us': p50 * 1e6, 'p99 us': p99 * 1e6})
+  finally:
+    server.terminate()
+    server.join()
+  return rows
+
+
+def _print_rows(rows):
+  columns = list(rows[0])
+  print(' '.join(f'{name:>13}' for name in columns))
+  for row in rows:
+    print(' '.join(f'{row[name]:>13.{0 if row[name] >= 100 else 4}f}' if isinstance(row[name], float) else f'{row[name]:>13}' for name in columns))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='micro benchmarks for the multi level cache')
+  parser.add_argument('benchmark', choices=['index', 'threads', 'batch', 'memory', 'processes', 'compression', 'server', 'watermarks'])
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+  parser.add_argument('--ops', type=int, default=20_000)
+  parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='threads, or requests in flight for server')
+  parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+  args = parser.parse_args(argv)
+
+  if args.benchmark == 'index':
+    _print_rows(bench_index(args.sizes, args.ops))
+  elif args.benchmark == 'threads':
+    _print_rows(bench_threads(args.threads, args.ops))
+  elif args.benchmark == 'batch':
+    _print_rows(bench_batch())
+  elif args.benchmark == 'memory':
+    _print_rows(bench_memory(args.sizes))
+  elif args.benchmark == 'processes':
+    _print_rows(bench_processes(args.processes, args.ops))
+  elif args.benchmark == 'compression':
+    _print_rows(bench_compression(ops=args.ops))
+  elif args.benchmark == 'server':
+    _print_rows(bench_server(args.threads, args.ops))
+  elif args.benchmark == 'watermarks':
+    _print_rows(bench_watermarks())
+
+
+if __name__ == '__main__':
+  main()
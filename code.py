@@ -1,8 +1,34 @@
+import array
+import asyncio
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import hashlib
+import heapq
+import inspect
+import lzma
+import math
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+from collections import Counter, OrderedDict, deque
+
+
 class Node:
+  __slots__ = ('value', 'next', 'previous', 'expires')  #no __dict__, a node is four pointers
+
   def __init__(self, content):
     self.value = content
     self.next = None
     self.previous = None
+    self.expires = None  #clock time after which the node is stale, None never expires
 
   def __str__(self):
     return ('CONTENT:{}\n'.format(self.value))
@@ -25,11 +51,14 @@ class ContentItem:
     >>> hash(content4)
     1
   '''
-  def __init__(self, cid, size, header, content):
+  __slots__ = ('cid', 'size', 'header', 'content', 'ttl')
+
+  def __init__(self, cid, size, header, content, ttl=None):
     self.cid = cid
     self.size = size
     self.header = header
     self.content = content
+    self.ttl = ttl  #seconds the content stays fresh once cached, None falls back to the cache default
 
   def __str__(self):
     return f'CONTENT ID: {self.cid} SIZE: {self.size} HEADER: {self.header} CONTENT: {self.content}'
@@ -41,6 +70,9 @@ class ContentItem:
       return self.cid == other.cid and self.size == other.size and self.header == other.header and self.content == other.content
     return False
 
+  def materialize(self):
+    return self  #already in memory, DiskContentItem overrides this to read its payload back
+
   def __hash__(self):
     total_sum = 0      #create the sum 
     for value in self.header:  #literate through the header 
@@ -50,6 +82,759 @@ class ContentItem:
 
 
 
+class EvictionPolicy:
+  '''
+    A CacheList keeps its own recency list (head is most recent, tail least recent) and
+    tells its policy about every insert, hit and removal. The policy only has to pick the
+    next victim when the list needs space. Policies are chosen by name or passed in as objects.
+
+    >>> make_policy('lfu')
+    LFUPolicy
+    >>> make_policy(ARCPolicy())
+    ARCPolicy
+    >>> Cache(100, ['lru', 'lfu', 'gdsf']).hierarchy[1].policy
+    LFUPolicy
+    >>> make_policy('fifo')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown eviction policy fifo
+  '''
+  name = None
+  stateless = False  #stateless policies only look at the recency list so they can be swapped per put call
+
+  def attach(self, cachelist):
+    self.cachelist = cachelist  #some policies size their segments from cachelist.maxSize
+    self.reset()
+
+  def reset(self):
+    pass
+
+  def inserting(self, content): #called before the list makes room for content
+    pass
+
+  def inserted(self, node):
+    pass
+
+  def accessed(self, node):
+    pass
+
+  def removed(self, node):
+    pass
+
+  def victim(self, cachelist, content):
+    raise NotImplementedError
+
+  def victims(self, cachelist, content):
+    #the nodes victim would hand out one after the other if nothing else changed, for admission checks
+    current = cachelist.tail
+    while current is not None:
+      yield current
+      current = current.previous
+
+  def __str__(self):
+    return type(self).__name__
+
+  __repr__ = __str__
+
+
+class LRUPolicy(EvictionPolicy):
+  name = 'lru'
+  stateless = True
+
+  def victim(self, cachelist, content):
+    return cachelist.tail  #tail is the least recently used
+
+
+class MRUPolicy(EvictionPolicy):
+  name = 'mru'
+  stateless = True
+
+  def victim(self, cachelist, content):
+    return cachelist.head  #head is the most recently used
+
+  def victims(self, cachelist, content):
+    current = cachelist.head
+    while current is not None:
+      yield current
+      current = current.next
+
+
+class LFUPolicy(EvictionPolicy):
+  '''
+    O(1) LFU: nodes sit in one bucket per use count, oldest first inside a bucket.
+
+    >>> lst = CacheList(30, 'lfu')
+    >>> for cid in (1, 2, 3):
+    ...     _ = lst.put(ContentItem(cid, 10, "lfu", cid))
+    >>> all(lst.get(cid) is not None for cid in (1, 1, 3))
+    True
+    >>> _ = lst.put(ContentItem(4, 10, "lfu", 4))
+    >>> sorted(lst.index)
+    [1, 3, 4]
+    >>> for _ in range(1000):
+    ...     _ = lst.get(4)
+    >>> len(lst.policy.counts) <= 2 * len(lst.policy.buckets) + 8
+    True
+  '''
+  name = 'lfu'
+
+  def reset(self):
+    self.freq = {}  #node -> use count
+    self.buckets = {}  #use count -> OrderedDict of nodes in the order they got that count
+    self.counts = []  #heap of counts that have a bucket, so finding the smallest is O(log n)
+
+  def _add(self, node, count):
+    self.freq[node] = count
+    bucket = self.buckets.get(count)
+    if bucket is None:
+      bucket = self.buckets[count] = OrderedDict()
+      heapq.heappush(self.counts, count)
+    bucket[node] = None
+
+  def _discard(self, node):
+    count = self.freq.pop(node)
+    bucket = self.buckets[count]
+    del bucket[node]
+    if not bucket:
+      del self.buckets[count]  #the heap entry goes stale and is skipped in victim
+      if len(self.counts) > 2 * len(self.buckets) + 8:  #more stale counts than live ones, so the heap stays as big as the buckets and not the number of hits
+        self.counts = list(self.buckets)
+        heapq.heapify(self.counts)
+    return count
+
+  def inserted(self, node):
+    self._add(node, 1)
+
+  def accessed(self, node):
+    self._add(node, self._discard(node) + 1)
+
+  def removed(self, node):
+    self._discard(node)
+
+  def victim(self, cachelist, content):
+    while self.counts[0] not in self.buckets:  #drop counts whose bucket emptied out
+      heapq.heappop(self.counts)
+    return next(iter(self.buckets[self.counts[0]]))
+
+  def victims(self, cachelist, content):
+    for count in sorted(self.buckets):
+      yield from self.buckets[count]
+
+
+class ClockPolicy(EvictionPolicy):
+  '''
+    CLOCK (second chance): the front of the ring is the hand, a hit only sets a reference bit.
+
+    >>> lst = CacheList(30, 'clock')
+    >>> for cid in (1, 2, 3):
+    ...     _ = lst.put(ContentItem(cid, 10, "clock", cid))
+    >>> lst.get(1) is not None
+    True
+    >>> _ = lst.put(ContentItem(4, 10, "clock", 4))
+    >>> sorted(lst.index)
+    [1, 3, 4]
+  '''
+  name = 'clock'
+
+  def reset(self):
+    self.ring = OrderedDict()  #node -> reference bit
+
+  def inserted(self, node):
+    self.ring[node] = False
+
+  def accessed(self, node):
+    self.ring[node] = True
+
+  def removed(self, node):
+    del self.ring[node]
+
+  def victim(self, cachelist, content):
+    while True:  #give referenced nodes a second chance by clearing the bit and moving the hand past them
+      node, referenced = next(iter(self.ring.items()))
+      if not referenced:
+        return node
+      self.ring[node] = False
+      self.ring.move_to_end(node)
+
+  def victims(self, cachelist, content):
+    yield from (node for node, referenced in self.ring.items() if not referenced)  #the hand passes referenced nodes once
+    yield from (node for node, referenced in self.ring.items() if referenced)
+
+
+class SLRUPolicy(EvictionPolicy):
+  '''
+    Segmented LRU: new items start in probation, a hit moves them to the protected segment,
+    and protected overflow falls back to probation. Victims come from probation first.
+
+    >>> lst = CacheList(30, SLRUPolicy(protected=0.5))
+    >>> for cid in (1, 2, 3):
+    ...     _ = lst.put(ContentItem(cid, 10, "slru", cid))
+    >>> lst.get(1) is not None
+    True
+    >>> _ = lst.put(ContentItem(4, 10, "slru", 4))
+    >>> sorted(lst.index)
+    [1, 3, 4]
+  '''
+  name = 'slru'
+
+  def __init__(self, protected=0.8):
+    self.protectedRatio = protected  #share of maxSize the protected segment may hold
+
+  def reset(self):
+    self.probation = OrderedDict()  #node -> size it was counted with
+    self.protected = OrderedDict()
+    self.protectedBytes = 0
+
+  def inserted(self, node):
+    self.probation[node] = node.value.size
+
+  def accessed(self, node):
+    if node in self.protected:
+      self.protectedBytes -= self.protected.pop(node)
+    else:
+      del self.probation[node]
+    self.protected[node] = node.value.size
+    self.protectedBytes += node.value.size
+
+    limit = self.protectedRatio * self.cachelist.maxSize
+    while self.protectedBytes > limit and len(self.protected) > 1: #demote the oldest protected nodes back to probation
+      demoted, size = self.protected.popitem(last=False)
+      self.protectedBytes -= size
+      self.probation[demoted] = size
+
+  def removed(self, node):
+    if node in self.protected:
+      self.protectedBytes -= self.protected.pop(node)
+    else:
+      del self.probation[node]
+
+  def victim(self, cachelist, content):
+    return next(iter(self.probation or self.protected))
+
+  def victims(self, cachelist, content):
+    yield from self.probation
+    yield from self.protected
+
+
+class TwoQPolicy(EvictionPolicy):
+  '''
+    Full 2Q: first-time items go through a FIFO (A1in), items evicted from it are remembered
+    by cid in a ghost queue (A1out), and only a re-reference of a ghost enters the LRU main queue (Am).
+    A one-time scan therefore only ever flushes A1in.
+
+    >>> lst = CacheList(40, '2q')
+    >>> for cid in (1, 2, 3, 4):
+    ...     _ = lst.put(ContentItem(cid, 10, "2q", cid))
+    >>> _ = lst.put(ContentItem(5, 10, "2q", 5))
+    >>> sorted(lst.index), list(lst.policy.a1out)
+    ([2, 3, 4, 5], [1])
+    >>> _ = lst.put(ContentItem(1, 10, "2q", 1))
+    >>> [node.value.cid for node in lst.policy.am]
+    [1]
+  '''
+  name = '2q'
+
+  def __init__(self, kin=0.25, kout=0.5):
+    self.kin = kin  #share of maxSize for A1in
+    self.kout = kout  #ghost entries kept, as a share of the items in the list
+
+  def reset(self):
+    self.a1in = OrderedDict()  #node -> size
+    self.a1inBytes = 0
+    self.am = OrderedDict()
+    self.a1out = OrderedDict()  #cid -> None, no content kept
+
+  def inserted(self, node):
+    cid = node.value.cid
+    if cid in self.a1out:  #seen recently enough, goes straight to the main queue
+      del self.a1out[cid]
+      self.am[node] = None
+    else:
+      self.a1in[node] = node.value.size
+      self.a1inBytes += node.value.size
+
+  def accessed(self, node):
+    if node in self.am:
+      self.am.move_to_end(node)
+
+  def removed(self, node):
+    if node in self.a1in:
+      self.a1inBytes -= self.a1in.pop(node)
+      self.a1out[node.value.cid] = None
+      while len(self.a1out) > max(1, int(self.kout * (self.cachelist.numItems + 1))):
+        self.a1out.popitem(last=False)
+    else:
+      del self.am[node]
+
+  def victim(self, cachelist, content):
+    if self.a1in and (self.a1inBytes > self.kin * cachelist.maxSize or not self.am):
+      return next(iter(self.a1in))
+    return next(iter(self.am))
+
+  def victims(self, cachelist, content):
+    yield from self.a1in
+    yield from self.am
+
+
+class ARCPolicy(EvictionPolicy):
+  '''
+    Adaptive Replacement Cache, weighted by size: T1 holds items seen once, T2 items seen more
+    than once, B1/B2 remember the cids recently evicted from each. Ghost hits move the target
+    size p of T1 towards whichever side would have kept the item.
+
+    >>> lst = CacheList(30, 'arc')
+    >>> for cid in (1, 2, 3):
+    ...     _ = lst.put(ContentItem(cid, 10, "arc", cid))
+    >>> lst.get(1) is not None
+    True
+    >>> _ = lst.put(ContentItem(4, 10, "arc", 4))
+    >>> sorted(lst.index), list(lst.policy.b1)
+    ([1, 3, 4], [2])
+    >>> _ = lst.put(ContentItem(2, 10, "arc", 2))
+    >>> lst.policy.p > 0
+    True
+    >>> _ = lst.put(ContentItem(5, 0, "arc", 5)); _ = lst.remove(5)
+    >>> lst.put(ContentItem(5, 0, "arc", 5)) is not None
+    True
+  '''
+  name = 'arc'
+
+  def reset(self):
+    self.t1 = OrderedDict()  #node -> size
+    self.t2 = OrderedDict()
+    self.b1 = OrderedDict()  #cid -> size
+    self.b2 = OrderedDict()
+    self.t1Bytes = self.t2Bytes = self.b1Bytes = self.b2Bytes = 0
+    self.p = 0  #target bytes for T1
+    self.ghostHits = {}  #cid -> True if found in B2, for items about to be inserted after a ghost hit
+
+  def inserting(self, content):
+    cid = content.cid
+    c = self.cachelist.maxSize
+    if cid in self.b1:  #would have been a hit if T1 was bigger
+      self.p = min(c, self.p + max(self.b2Bytes / max(self.b1Bytes, 1), 1) * content.size)  #a ghost list of zero-size items has no bytes to divide by
+      self.b1Bytes -= self.b1.pop(cid)
+      self.ghostHits[cid] = False
+    elif cid in self.b2:  #would have been a hit if T2 was bigger
+      self.p = max(0, self.p - max(self.b1Bytes / max(self.b2Bytes, 1), 1) * content.size)
+      self.b2Bytes -= self.b2.pop(cid)
+      self.ghostHits[cid] = True
+
+  def inserted(self, node):
+    size = node.value.size
+    if self.ghostHits.pop(node.value.cid, None) is not None:
+      self.t2[node] = size
+      self.t2Bytes += size
+    else:
+      self.t1[node] = size
+      self.t1Bytes += size
+    self._trim()
+
+  def accessed(self, node):
+    if node in self.t1:
+      self.t1Bytes -= self.t1.pop(node)
+    else:
+      self.t2Bytes -= self.t2.pop(node)
+    self.t2[node] = node.value.size
+    self.t2Bytes += node.value.size
+
+  def removed(self, node):
+    cid = node.value.cid
+    if node in self.t1:
+      size = self.t1.pop(node)
+      self.t1Bytes -= size
+      self.b1[cid] = size
+      self.b1Bytes += size
+    else:
+      size = self.t2.pop(node)
+      self.t2Bytes -= size
+      self.b2[cid] = size
+      self.b2Bytes += size
+    self._trim()
+
+  def _trim(self): #keep the ghosts bounded: T1+B1 <= c and everything <= 2c
+    c = self.cachelist.maxSize
+    while self.b1 and self.t1Bytes + self.b1Bytes > c:
+      self.b1Bytes -= self.b1.popitem(last=False)[1]
+    while self.b2 and self.t1Bytes + self.t2Bytes + self.b1Bytes + self.b2Bytes > 2 * c:
+      self.b2Bytes -= self.b2.popitem(last=False)[1]
+
+  def victim(self, cachelist, content):
+    inB2 = content is not None and self.ghostHits.get(content.cid) is True
+    if self.t1 and (self.t1Bytes > self.p or (inB2 and self.t1Bytes == self.p) or not self.t2):
+      return next(iter(self.t1))
+    return next(iter(self.t2))
+
+  def victims(self, cachelist, content):
+    first, second = (self.t1, self.t2) if self.t1Bytes > self.p or not self.t2 else (self.t2, self.t1)
+    yield from first
+    yield from second
+
+
+class GDSFPolicy(EvictionPolicy):
+  '''
+    GreedyDual-Size-Frequency: priority = L + frequency * cost / size, evict the lowest and
+    raise L to its priority so long-idle items age out. Small popular items are kept over big ones.
+
+    >>> lst = CacheList(100, 'gdsf')
+    >>> _ = lst.put(ContentItem(1, 60, "gdsf", "big"))
+    >>> _ = lst.put(ContentItem(2, 10, "gdsf", "small"))
+    >>> _ = lst.put(ContentItem(3, 40, "gdsf", "new"))
+    >>> sorted(lst.index)
+    [2, 3]
+  '''
+  name = 'gdsf'
+
+  def __init__(self, cost=None):
+    self.cost = cost  #cost(content) of fetching it again, 1 by default which optimises hit ratio
+
+  def reset(self):
+    self.L = 0
+    self.freq = {}  #node -> use count
+    self.priority = {}  #node -> (H, seq) of its live heap entry
+    self.heap = []
+    self.seq = 0
+    self.evicting = None  #node handed out by victim, its removal is what ages L
+
+  def _push(self, node):
+    content = node.value
+    cost = 1 if self.cost is None else self.cost(content)
+    entry = (self.L + self.freq[node] * cost / max(content.size, 1), self.seq, node)
+    self.seq += 1
+    self.priority[node] = entry[:2]
+    heapq.heappush(self.heap, entry)
+    if len(self.heap) > 2 * len(self.priority) + 64:  #too many stale entries, rebuild
+      self.heap = [(h, seq, n) for n, (h, seq) in self.priority.items()]
+      heapq.heapify(self.heap)
+
+  def inserted(self, node):
+    self.freq[node] = 1
+    self._push(node)
+
+  def accessed(self, node):
+    self.freq[node] += 1
+    self._push(node)
+
+  def removed(self, node):
+    del self.freq[node]
+    h = self.priority.pop(node)[0]
+    if node is self.evicting:  #evicting the minimum ages everyone else
+      self.L = h
+      self.evicting = None
+
+  def victim(self, cachelist, content):
+    while True:
+      h, seq, node = self.heap[0]
+      if self.priority.get(node) == (h, seq):
+        self.evicting = node
+        return node
+      heapq.heappop(self.heap)
+
+  def victims(self, cachelist, content):
+    frontier = [(self.heap[0], 0)] if self.heap else []  #walk the heap smallest first without popping it
+    while frontier:
+      (h, seq, node), position = heapq.heappop(frontier)
+      if self.priority.get(node) == (h, seq):
+        yield node
+      for child in (2 * position + 1, 2 * position + 2):
+        if child < len(self.heap):
+          heapq.heappush(frontier, (self.heap[child], child))
+
+
+def mix_hash(cid):
+  '''
+    Default key hash for sharding: splitmix64 for integer cids, blake2b for anything else.
+    Both are stable across processes, unlike hash() on strings.
+
+    >>> mix_hash(1) == mix_hash(1), mix_hash(1) == mix_hash(2)
+    (True, False)
+    >>> sorted(Counter(jump_hash(mix_hash(cid), 4) for cid in range(10000)).values())
+    [2399, 2499, 2551, 2551]
+  '''
+  if isinstance(cid, int):
+    z = (cid + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return z ^ (z >> 31)
+  data = cid if isinstance(cid, bytes) else str(cid).encode()
+  return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def jump_hash(key, buckets):
+  #Lamping and Veach jump consistent hash, going from n to n+1 buckets only moves 1/(n+1) of the keys
+  b, j = -1, 0
+  while j < buckets:
+    b = j
+    key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+    j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+  return b
+
+
+POLICIES = {policy.name: policy for policy in (LRUPolicy, MRUPolicy, LFUPolicy, ClockPolicy, SLRUPolicy, TwoQPolicy, ARCPolicy, GDSFPolicy)}
+
+
+def make_policy(policy):
+  if isinstance(policy, EvictionPolicy):
+    return policy
+  cls = POLICIES.get(str(policy).lower())
+  if cls is None:
+    raise ValueError(f'Unknown eviction policy {policy}')
+  return cls()
+
+
+HALVE = bytes(count >> 1 for count in range(256))  #translate table that halves every counter of a sketch row
+
+
+class TinyLFU:
+  '''
+    Admission filter in front of CacheList.put. Lookups are counted in a count-min sketch of
+    counters that stop at 15, one byte each so a row halves with one translate, behind a Bloom
+    filter doorkeeper, so a cid seen once only costs a few bits.
+    Every sampleSize records the counters are halved and the doorkeeper is cleared so old
+    popularity fades. When a put has to evict, the candidate is admitted only if it has been
+    asked for more often than every victim it would push out. Memory is fixed by width.
+
+    >>> lst = CacheList(30, 'lru', admission='tinylfu')
+    >>> for cid in (1, 2, 3):
+    ...     _ = lst.put(ContentItem(cid, 10, "hot", cid))
+    >>> for _ in range(3):
+    ...     hits = [lst.get(cid) for cid in (1, 2, 3)]
+    >>> for cid in range(100, 110):
+    ...     if lst.get(cid) is None:
+    ...         result = lst.put(ContentItem(cid, 10, "scan", cid))
+    >>> result, sorted(lst.index)
+    ('Content 109 not admitted', [1, 2, 3])
+    >>> for _ in range(5):
+    ...     _ = lst.get(200)
+    >>> lst.put(ContentItem(200, 10, "popular", 200)), sorted(lst.index)
+    ('INSERTED: CONTENT ID: 200 SIZE: 10 HEADER: popular CONTENT: 200', [2, 3, 200])
+  '''
+  depth = 4
+
+  def __init__(self, width=None, sampleSize=None, doorkeeper=True):
+    self.width = width  #counters per row, None sizes it from the list it is attached to
+    self.sampleSize = sampleSize
+    self.doorkeeper = doorkeeper
+
+  def attach(self, cachelist):
+    if self.width is None:  #about one counter per byte of capacity, kept between 64 and 1M
+      self.width = 1 << max(6, min(20, (cachelist.maxSize - 1).bit_length()))
+    self.mask = self.width - 1
+    if self.sampleSize is None:
+      self.sampleSize = 10 * self.width
+    self.reset()
+
+  def reset(self):
+    self.rows = [bytearray(self.width) for _ in range(self.depth)]
+    self.door = bytearray(self.width // 8 + 1)  #one bit per counter
+    self.records = 0
+
+  def _slots(self, cid):
+    h = mix_hash(cid)
+    low, high = h & 0xFFFFFFFF, (h >> 32) | 1
+    return [(low + i * high) & self.mask for i in range(self.depth)]
+
+  def record(self, cid):
+    slots = self._slots(cid)
+    if self.doorkeeper:
+      bit = slots[0]
+      if not self.door[bit >> 3] & (1 << (bit & 7)):  #first sighting only goes into the doorkeeper
+        self.door[bit >> 3] |= 1 << (bit & 7)
+        self._aged()
+        return
+    counts = [row[slot] for row, slot in zip(self.rows, slots)]
+    smallest = min(counts)
+    if smallest < 15:
+      for row, slot, count in zip(self.rows, slots, counts):
+        if count == smallest:  #conservative update, only the counters holding the estimate grow
+          row[slot] = count + 1
+    self._aged()
+
+  def _aged(self):
+    self.records += 1
+    if self.records >= self.sampleSize:
+      for row in self.rows:
+        row[:] = row.translate(HALVE)  #one table lookup per byte in C, a python loop over 1M counters stalls the shard
+      self.door = bytearray(len(self.door))
+      self.records //= 2
+
+  def estimate(self, cid):
+    slots = self._slots(cid)
+    count = min(row[slot] for row, slot in zip(self.rows, slots))
+    if self.doorkeeper and self.door[slots[0] >> 3] & (1 << (slots[0] & 7)):
+      count += 1
+    return count
+
+  def admit(self, content, need, victims):
+    frequency = self.estimate(content.cid)
+    freed = 0
+    for node in victims:
+      if self.estimate(node.value.cid) >= frequency:  #it would push out something at least as popular
+        return False
+      freed += node.value.size
+      if freed >= need:
+        break
+    return True
+
+  def __str__(self):
+    return type(self).__name__
+
+  __repr__ = __str__
+
+
+def make_admission(admission):
+  if admission is None or admission is False:
+    return None
+  if isinstance(admission, TinyLFU):
+    return copy.deepcopy(admission)  #the sketch is per list, an instance is used as a template
+  if admission is True or str(admission).lower() == 'tinylfu':
+    return TinyLFU()
+  raise ValueError(f'Unknown admission policy {admission}')
+
+
+
+class TimingWheel:
+  '''
+    Hierarchical timing wheel: level 0 has one slot per tick, every level above covers a whole
+    turn of the level below per slot. Scheduling is O(1), and advancing costs O(1) per tick plus
+    the entries that expire or cascade down a level, so nothing ever scans the cache.
+
+    >>> wheel = TimingWheel(tick=1, slots=4, levels=2)
+    >>> for name, when in (('a', 2), ('b', 5), ('c', 9), ('d', 40)):
+    ...     wheel.schedule(name, when)
+    >>> wheel.advance(1), wheel.advance(5), wheel.advance(8)
+    ([], ['a', 'b'], [])
+    >>> sorted(wheel.advance(100)), len(wheel)
+    (['c', 'd'], 0)
+  '''
+  def __init__(self, tick=1.0, slots=64, levels=4, now=0):
+    self.tick = tick
+    self.slots = slots
+    self.levels = levels
+    self.span = slots ** levels  #ticks the wheels can hold, anything further waits in overflow
+    self.current = int(now // tick)
+    self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+    self.overflow = []
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def schedule(self, item, expires):
+    when = max(math.ceil(expires / self.tick), self.current + 1)  #first tick at or after expires
+    self._place(item, when)
+    self.count += 1
+
+  def _place(self, item, when):
+    delta = when - self.current
+    width = 1
+    for wheel in self.wheels:
+      if delta < width * self.slots:  #the lowest level whose turn still reaches when
+        wheel[(when // width) % self.slots].append((when, item))
+        return
+      width *= self.slots
+    self.overflow.append((when, item))
+
+  def advance(self, now):
+    target = int(now // self.tick)
+    expired = []
+    if target - self.current >= self.span:  #idle for longer than the wheel covers, sort everything out in one go
+      entries = self.overflow
+      self.overflow = []
+      for wheel in self.wheels:
+        for slot in wheel:
+          entries.extend(slot)
+          slot.clear()
+      self.current = target
+      for when, item in entries:
+        if when <= target:
+          expired.append(item)
+        else:
+          self._place(item, when)
+      self.count -= len(expired)
+      return expired
+
+    while self.current < target:
+      self.current += 1
+      width = self.slots
+      cascade = []
+      for level in range(1, self.levels):  #a level turns over whenever the tick is a multiple of its slot width
+        if self.current % width:
+          break
+        cascade.append((level, width))
+        width *= self.slots
+      if self.current % self.span == 0:
+        entries, self.overflow = self.overflow, []  #the top level turned over so the overflow may fit now
+        for when, item in entries:
+          self._place(item, when)
+      for level, width in reversed(cascade):  #highest first so entries can fall more than one level in a tick
+        slot = (self.current // width) % self.slots
+        entries, self.wheels[level][slot] = self.wheels[level][slot], []
+        for when, item in entries:
+          self._place(item, when)
+      slot = self.current % self.slots
+      entries, self.wheels[0][slot] = self.wheels[0][slot], []
+      for when, item in entries:
+        if when <= self.current:
+          expired.append(item)
+        else:
+          self._place(item, when)
+    self.count -= len(expired)
+    return expired
+
+
+class LatencyHistogram:
+  '''
+    Power of two buckets of nanoseconds, recording is one bit_length and one list increment.
+
+    >>> histogram = LatencyHistogram()
+    >>> for ns in (100, 120, 900, 5000):
+    ...     histogram.record(ns)
+    >>> histogram.count, histogram.percentile(0.5), histogram.percentile(0.99)
+    (4, 128, 8192)
+  '''
+  def __init__(self):
+    self.buckets = [0] * 64  #bucket b counts samples below 2**b ns
+    self.count = 0
+    self.total = 0
+
+  def record(self, ns):
+    self.buckets[min(ns.bit_length(), 63)] += 1
+    self.count += 1
+    self.total += ns
+
+  def percentile(self, fraction):
+    #upper bound of the bucket the sample at that rank fell in
+    rank = fraction * self.count
+    seen = 0
+    for bucket, count in enumerate(self.buckets):
+      seen += count
+      if count and seen >= rank:
+        return 1 << bucket
+    return 0
+
+
+class CacheStats:
+  #counters for one CacheList, only made when stats are turned on so an untouched list pays a None check
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.inserts = 0
+    self.updates = 0
+    self.rejected = 0  #puts answered with "Insertion not allowed"
+    self.expired = 0
+    self.evictions = Counter()  #policy name -> evictions it picked
+    self.evictedBytes = 0
+    self.denied = 0  #puts the admission filter turned away
+    self.reclaimed = 0  #evictions done by reclaim, off the insert path
+    self.listeners = {'evict': [], 'miss': []}  #callbacks(cachelist, content or cid)
+
+  def snapshot(self):
+    return {'hits': self.hits, 'misses': self.misses, 'inserts': self.inserts, 'updates': self.updates, 'rejected': self.rejected,
+            'expired': self.expired, 'evictions': dict(self.evictions), 'evicted bytes': self.evictedBytes, 'denied': self.denied,
+            'reclaimed': self.reclaimed}
+
+
 class CacheList:
   ''' 
     >>> content1 = ContentItem(1000, 10, "Content-Type: 0", "0xA")
@@ -65,17 +850,23 @@ class CacheList:
     <BLANKLINE>
     >>> lst.put(content1, 'mru')
     'INSERTED: CONTENT ID: 1000 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 0xA'
-     >>> lst.put(content2, 'lru')
+    >>> lst.put(content2, 'lru')
     'INSERTED: CONTENT ID: 1004 SIZE: 50 HEADER: Content-Type: 1 CONTENT: 110010'
     >>> lst.put(content4, 'mru')
     'INSERTED: CONTENT ID: 1006 SIZE: 18 HEADER: another header CONTENT: 111110'
     >>> lst.put(content5, 'mru')
     'INSERTED: CONTENT ID: 1008 SIZE: 2 HEADER: items CONTENT: 11x1110'
     >>> lst.put(content3, 'lru')
-    "INSERTED: CONTENT ID: 1005 SIZE: 180 HEADER: Content-Type: 2 CONTENT: <html <p>'CMPSC132'</p></html>"
+    "INSERTED: CONTENT ID: 1005 SIZE: 180 HEADER: Content-Type: 2 CONTENT: <html><p>'CMPSC132'</p></html>"
     >>> lst.put(content1, 'mru')
     'INSERTED: CONTENT ID: 1000 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 0xA'
-    >>> 1006 in lst
+    >>> 1006 in lst, lst.head.value.cid
+    (True, 1000)
+    >>> lst.peek(1006)
+    CONTENT ID: 1006 SIZE: 18 HEADER: another header CONTENT: 111110
+    >>> lst.get(1006).value.cid, lst.head.value.cid
+    (1006, 1006)
+    >>> lst.get(1005) is None
     True
     >>> contentExtra = ContentItem(1034, 2, "items", "other content")
     >>> lst.update(1008, contentExtra)
@@ -88,6 +879,8 @@ class CacheList:
     [CONTENT ID: 1006 SIZE: 18 HEADER: another header CONTENT: 111110]
     [CONTENT ID: 1000 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 0xA]
     <BLANKLINE>
+    >>> lst.update(1034, ContentItem(1006, 2, "items", "taken")), lst.verify()
+    ('Cache miss!', True)
     >>> lst.tail.value
     CONTENT ID: 1000 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 0xA
     >>> lst.tail.previous.value
@@ -107,21 +900,33 @@ class CacheList:
     <BLANKLINE>
   '''
 
-  def __init__(self, size):
+  def __init__(self, size, policy='lru', ttl=None, clock=time.monotonic, tick=1.0, admission=None):
       
       self.head = None
       self.tail = None
       self.maxSize = size
       self.remainingSpace = size
       self.numItems = 0
+      self.index = {}  #cid -> Node so we can find any node without walking the link list
+      self.policy = make_policy(policy)  #the policy that gets told about every insert, hit and removal
+      self.policy.attach(self)
+      self.onEvict = None  #called with every evicted node, Cache uses it to demote into the next level
+      self.ttl = ttl  #default seconds to live for content without its own ttl
+      self.clock = clock
+      self.tick = tick
+      self.wheel = None  #made on the first put that has an expiry
+      self.stats = None  #CacheStats once enableStats is called, every counter is skipped while it is None
+      self.admission = make_admission(admission)  #TinyLFU or None to admit everything that fits
+      if self.admission is not None:
+        self.admission.attach(self)
+      self.high = None  #bytes in use that wake the evictor, None leaves all eviction to put
+      self.low = None  #bytes in use reclaim brings the list back down to
+      self.onPressure = None  #called with the list when it goes over high, Cache hands it to its Evictor
+      self.pressured = False  #already reported, reclaim clears it
 
   def __str__(self):
       
-      listString = ""
-      current = self.head
-      while current is not None:
-          listString += "[" + str(current.value) + "]\n"
-          current = current.next
+      listString = "".join(f"[{content}]\n" for content in self)  #one join instead of growing the string item by item
       return 'REMAINING SPACE:{}\nITEMS:{}\nLIST:\n{}'.format(self.remainingSpace, self.numItems, listString)
 
   __repr__ = __str__
@@ -129,136 +934,1149 @@ class CacheList:
   def __len__(self):
       return self.numItems
 
-  def put(self, content, evictionPolicy):     
+  def __iter__(self):
+      current = self.head  #most recent first, same order __str__ prints
+      while current is not None:
+          yield current.value
+          current = current.next
+
+  def put(self, content, evictionPolicy=None, expires=None, admit=True):     
 
+    if self.wheel is not None:  #drop whatever went stale before we think about evicting live content
+      self.expire()
     if content.size > self.maxSize:  #As Gabriel mention on review check if content is to big to be put into Cache list if it is we return Insertion not allowed
+      if self.stats is not None:
+        self.stats.rejected += 1
       return "Insertion not allowed"
-    elif self.__contains__(content.cid) == True: #we checking if the cid is already in the linklist if it is we return Content {id} already in cache, insertion not allowed, I used the __contains__ we wrote before to make it easier
+    elif self._live(content.cid) is not None: #we checking if the cid is already in the linklist if it is we return Content {id} already in cache, insertion not allowed, checking doesn't touch the recency order
       return f"Content {content.cid} already in cache, insertion not allowed"
 
+    policy = self._policyFor(evictionPolicy)  #'lru'/'mru' can be picked per call, anything else becomes the list policy
+    if admit and not self.admits(content, policy):  #admit=False is for content the cache already holds and is only moving
+      if self.stats is not None:
+        self.stats.denied += 1
+      return f"Content {content.cid} not admitted"
+    self.policy.inserting(content)
     while self.remainingSpace < content.size: #we will try to make space to insert the thing by evict as mention by gabriel
-      if evictionPolicy == "mru":  #either by mruEvict
-        self.mruEvict()    #called the written function
-      elif evictionPolicy == "lru":#or either lruEvict
-        self.lruEvict()    #called the written function 
-      
+      self._evict(policy.victim(self, content), policy)  #the policy picks, the list does the unlinking
+
+    self._link(content, expires)
+    if self.onPressure is not None:
+      self._checkPressure()
+    return f'INSERTED: {content}' #return INSERTED: {content}
 
+  def _link(self, content, expires=None, atTail=False):
     new_node = Node(content) #remember when we get to this point we have enough space so we make a new node
     if self.head is None:  #if the link list is empty 
       self.head = new_node # we make the head and tail into the new node cause thats the only node we adding
       self.tail = new_node
+    elif atTail:  #restoring a snapshot goes head to tail so each node goes behind the last one
+      new_node.previous = self.tail
+      self.tail.next = new_node
+      self.tail = new_node
     else:                        #if the link list is not empty meaning we have something
       new_node.next = self.head   #in a link list we want to add the new node in the front so the new node next is the current head 
       self.head.previous = new_node #now the head previous we need to link to the new node
       self.head = new_node #male the head to new_node
 
+    self.index[content.cid] = new_node #remember where the node is so lookups don't walk the list
     self.remainingSpace -= content.size #remainingSpace must be decreased by the size of the content we added
     self.numItems += 1 #the number of item increase by 1
+    if not atTail:  #a restore replays the policy once the whole list is back
+      self.policy.inserted(new_node)
+    if self.stats is not None:
+      self.stats.inserts += 1
 
-    return f'INSERTED: {content}' #return INSERTED: {content}
+    ttl = content.ttl if content.ttl is not None else self.ttl
+    if expires is None and ttl is not None:
+      expires = self.clock() + ttl
+    if expires is not None:  #moves between levels keep the original expiry instead of starting over
+      new_node.expires = expires
+      if self.wheel is None:
+        self.wheel = TimingWheel(self.tick, now=self.clock())
+      self.wheel.schedule(new_node, expires)
+    return new_node
+
+  def put_many(self, contents, evictionPolicy=None, expires=None):
+    #insert a batch: check everything first, evict for each chunk that fits, then link the chunk in
+    if self.admission is not None:  #every item is judged against the victims it would push out, so one at a time
+      return [self.put(content, evictionPolicy, expires) for content in contents]
+    if self.wheel is not None:
+      self.expire()
+    results = []
+    accepted = []
+    batch = set()
+    for content in contents:
+      if content.size > self.maxSize:
+        results.append("Insertion not allowed")
+        if self.stats is not None:
+          self.stats.rejected += 1
+      elif content.cid in batch or self._live(content.cid) is not None:
+        results.append(f"Content {content.cid} already in cache, insertion not allowed")
+      else:
+        batch.add(content.cid)
+        accepted.append(content)
+        results.append(f'INSERTED: {content}')
 
-  def __contains__(self, cid):  
-    current = self.head  #set current to head
+    policy = self._policyFor(evictionPolicy)
+    start = 0
+    while start < len(accepted):  #a batch bigger than the list goes in as chunks that each fit, like one by one would
+      end, need = start, 0
+      while end < len(accepted) and need + accepted[end].size <= self.maxSize:
+        need += accepted[end].size
+        end += 1
+      for content in accepted[start:end]:
+        self.policy.inserting(content)
+      while self.remainingSpace < need:  #still one victim at a time, the policy has to see each eviction
+        self._evict(policy.victim(self, accepted[start]), policy)
+      for content in accepted[start:end]:
+        self._link(content, expires)
+      start = end
+    if self.onPressure is not None:
+      self._checkPressure()
+    return results
 
-    while current is not None:  #while current is not None
-      if current.value.cid == cid: #compare the cid
-        self.update(current.value.cid, current.value) #I got help with this line by TA Sabih 
-        return True  #return true if cid is found
-      current = current.next #update current to next node 
-    return False  #otherwise return False
+  def setWatermarks(self, high, low):
+    #fractions of maxSize: going over high asks for a reclaim, reclaim evicts down to low
+    if not 0 < low <= high <= 1:
+      raise ValueError('watermarks need 0 < low <= high <= 1')
+    self.high = high * self.maxSize
+    self.low = low * self.maxSize
+
+  def _checkPressure(self):
+    if self.maxSize - self.remainingSpace > self.high and not self.pressured:
+      self.pressured = True  #one report per trip over the mark, not one per put
+      self.onPressure(self)
+
+  def reclaim(self, limit=None):
+    '''
+      Evict down to the low watermark in one go, the policy picks every victim like put would.
+      Meant to run off the insert path so put only has to evict when the list is really full.
+      Returns how many items went, at most limit so a caller holding a lock can let go between
+      rounds.
+
+      >>> lst = CacheList(100)
+      >>> lst.setWatermarks(0.8, 0.5)
+      >>> for cid in range(9):
+      ...     _ = lst.put(ContentItem(cid, 10, "Content-Type: 0", cid))
+      >>> lst.reclaim(), lst.remainingSpace, [item.cid for item in lst]
+      (4, 50, [8, 7, 6, 5, 4])
+    '''
+    if self.low is None:
+      self.pressured = False
+      return 0
+    evicted = 0
+    while self.numItems and self.maxSize - self.remainingSpace > self.low and evicted != limit:
+      self._evict(self.policy.victim(self, None), self.policy)
+      evicted += 1
+    self.pressured = self.numItems > 0 and self.maxSize - self.remainingSpace > self.low  #stopped at the limit, still owes a reclaim
+    if self.stats is not None:
+      self.stats.reclaimed += evicted
+    return evicted
+
+  def admits(self, content, evictionPolicy=None):
+    if self.admission is None or content.size <= self.remainingSpace:  #only a put that has to evict can be turned away
+      return True
+    policy = self.policy if evictionPolicy is None else make_policy(evictionPolicy)
+    return self.admission.admit(content, content.size - self.remainingSpace, policy.victims(self, content))
+
+  def _node(self, cid):
+    return self.index.get(cid)  #look the cid up in the index instead of walking from head
+
+  def holds(self, node):
+    return self.index.get(node.value.cid) is node  #the node is still the one linked in for its cid
+
+  def _live(self, cid):
+    node = self._node(cid)
+
+    if node is None:  #not in the index means not in the link list
+      return None
+    if node.expires is not None and node.expires <= self.clock():  #stale content counts as a miss and goes away now
+      self._unlink(node)
+      if self.stats is not None:
+        self.stats.expired += 1
+      return None
+    return node
+
+  def contains(self, cid):
+    return self.find(cid) is not None  #pure membership, the recency order is left alone
+
+  __contains__ = contains
+
+  def peek(self, cid):
+    node = self.find(cid)  #read the content without counting it as a use
+    return None if node is None else node.value
+
+  def get(self, cid):
+    if self.admission is not None:  #the admission filter learns from every lookup, hit or miss
+      self.admission.record(cid)
+    node = self._live(cid)  #one index lookup, a hit is moved to the head
+    if node is None:
+      if self.stats is not None:
+        self._missed(cid)
+      return None
+    if self.stats is not None:
+      self.stats.hits += 1
+    self._touch(node)
+    return node
 
-  
 
   def update(self, cid, content):
-    head = self.head  # set head to head
-    while head is not None:  #literate through the link list
-      if head.value.cid == cid: #check if the cid is the same
-        previous_content = head.value.size  #set the previous content to the size of the content
-        if content.size <= self.remainingSpace + previous_content: #check if there is enough space for the new content
-          if self.maxSize >= self.remainingSpace + previous_content - content.size: #make sure there is enough space for the new content 
-            self.remainingSpace += previous_content - content.size #update the remainingSpace 
-            head.value = content #update the head value to content which is the new value
-
-                      
-            if head != self.head: #make sure the current node is not the head 
-              previous = head.previous #set previous to the head previous
-              next_head = head.next  #next_head is the head next 
-
-              if next_head is not None: #make sure the next head is not None
-
-                next_head.previous = previous #link the next_head to the previous 
-              else:
-                self.tail = previous  #if the next_head is None in a link list we can link the tail to the previous
+    head = self.index.get(cid)  #find the node straight from the index
+    if head is None:  #when cid not found in the linklist so return 'Cache miss!'
+      return 'Cache miss!'
+    if content.cid != cid and content.cid in self.index:  #renaming onto a cid that is already here would leave its node linked but unindexed
+      return 'Cache miss!'
 
+    previous_content = head.value.size  #set the previous content to the size of the content
+    if content.size <= self.remainingSpace + previous_content: #check if there is enough space for the new content
+      if self.maxSize >= self.remainingSpace + previous_content - content.size: #make sure there is enough space for the new content 
+        self.remainingSpace += previous_content - content.size #update the remainingSpace 
+        head.value = content #update the head value to content which is the new value
+        if content.cid != cid: #the new content can come with a different cid so we move the index entry too
+          del self.index[cid]
+          self.index[content.cid] = head
 
-              #let me just write this in one sentence. I am trying to rearrange the link list trying to make the head the updated one and make it in order cause if it is not in order it gives me error for some reason so I just make it in order like making the head value the one we updtaed 
-              if previous is not None:
-                previous.next = next_head
-              else:
-                self.head = next_head
+        self._touch(head)  #move it to the head since we just used it
+        if self.stats is not None:
+          self.stats.updates += 1
+        return f'UPDATED: {content}' #if we get here we updated the thing so return the updated:{}
+      else:
+        return 'Cache miss!'  #if it exceed max size we return 'Cache miss!'
+    else:
+      return 'Cache miss!'   #content is to big so return 'Cache miss!'
 
-              head.next = self.head
-              head.previous = None
-              self.head.previous = head
-              self.head = head
+  def _touch(self, head):
+    if head != self.head: #make sure the current node is not the head 
+      previous = head.previous #set previous to the head previous
+      next_head = head.next  #next_head is the head next 
 
-            return f'UPDATED: {content}' #if we get here we updated the thing so return the updated:{}
-          else:
-            return 'Cache miss!'  #if it exceed max size we return 'Cache miss!'
-        else:
-          return 'Cache miss!'   #content is to big so return 'Cache miss!'
-      head = head.next #move the head to next node 
-    return 'Cache miss!' #when cid not found in the linklist so return 'Cache miss!'
+      if next_head is not None: #make sure the next head is not None
+
+        next_head.previous = previous #link the next_head to the previous 
+      else:
+        self.tail = previous  #if the next_head is None in a link list we can link the tail to the previous
+
+
+      #let me just write this in one sentence. I am trying to rearrange the link list trying to make the head the updated one and make it in order cause if it is not in order it gives me error for some reason so I just make it in order like making the head value the one we updtaed 
+      if previous is not None:
+        previous.next = next_head
+      else:
+        self.head = next_head
+
+      head.next = self.head
+      head.previous = None
+      self.head.previous = head
+      self.head = head
+
+    self.policy.accessed(head)  #an update or a hit counts as a use of the item
+
+  def _policyFor(self, evictionPolicy):
+    if evictionPolicy is None or evictionPolicy is self.policy or evictionPolicy == self.policy.name:
+      return self.policy
+    policy = make_policy(evictionPolicy)
+    if not policy.stateless:  #a stateful policy has to see the whole list so we switch the list over to it
+      self.setPolicy(policy)
+    return policy
+
+  def setPolicy(self, policy):
+    self.policy = make_policy(policy)
+    self.policy.attach(self)
+    current = self.tail  #replay the list oldest first so the new policy starts from the current contents
+    while current is not None:
+      self.policy.inserted(current)
+      current = current.previous
+
+  def _unlink(self, node):
+    previous = node.previous  #take the node out from between its neighbours
+    next_node = node.next
+    if previous is not None:
+      previous.next = next_node
+    else:
+      self.head = next_node  #it was the head
+    if next_node is not None:
+      next_node.previous = previous
+    else:
+      self.tail = previous  #it was the tail
+    node.next = None
+    node.previous = None
+
+    del self.index[node.value.cid]  #the cid is not in the list anymore
+    self.remainingSpace += node.value.size  #give its space back
+    self.numItems -= 1
+    self.policy.removed(node)
+    return node
+
+  def _evict(self, node, policy=None):
+    return self._evicted(self._unlink(node), policy)
+
+  def _evicted(self, node, policy):
+    stats = self.stats
+    if stats is not None:
+      stats.evictions[(policy or self.policy).name] += 1
+      stats.evictedBytes += node.value.size
+      for callback in stats.listeners['evict']:
+        callback(self, node.value)
+    if self.onEvict is not None:  #let whoever owns the list know the content is leaving
+      self.onEvict(node)
+    return node
+
+  def enableStats(self):
+    if self.stats is None:
+      self.stats = CacheStats()
+    return self.stats
 
+  def listen(self, event, callback):
+    #callback(cachelist, content) for every 'evict', callback(cachelist, cid) for every 'miss'
+    if event not in ('evict', 'miss'):
+      raise ValueError(f'Unknown cache event {event}')
+    self.enableStats().listeners[event].append(callback)
 
+  def _missed(self, cid):
+    stats = self.stats
+    stats.misses += 1
+    for callback in stats.listeners['miss']:
+      callback(self, cid)
 
+  def find(self, cid):
+    node = self._node(cid)  #lookup without side effects, stale nodes are left for the timing wheel
+    if node is None or (node.expires is not None and node.expires <= self.clock()):
+      return None
+    return node
+
+  def expire(self, now=None):
+    if self.wheel is None:
+      return 0
+    now = self.clock() if now is None else now
+    expired = 0
+    for node in self.wheel.advance(now):
+      #the wheel never cancels entries, so skip nodes that left the list or got a later expiry
+      if self.holds(node) and node.expires is not None and node.expires <= now:
+        self._unlink(node)
+        expired += 1
+    if self.stats is not None:
+      self.stats.expired += expired
+    return expired
 
+  def remove(self, cid):
+    node = self._node(cid)  #explicit removal, not an eviction so onEvict is not called
+    if node is None:
+      return None
+    return self._unlink(node).value
 
   def mruEvict(self): #revise
     if len(self) == 0:  #if the list is empty there nothing to delete cause head is already none so return None
       return None
-    
-    self.numItems -= 1    # if the size is not None we decrease the number of item by 1
-    self.remainingSpace += self.head.value.size  #increase the remaining space by the size of the head
-    head = self.head  #head is current head
-    next_head = self.head.next #make the next_head the next value
-    next_head.previous = None   #unlink the previous node
-    head.next = None    #remember it is a double link list so we unlink the head.next
-
-    self.head = next_head #set the head to the new head
-  
+    self._evict(self.head, MRUPolicy)  #the head is the most recently used
+
   def lruEvict(self):
     if len(self) == 0: #As gabriel mention the edge case when len is 0 return None
       return None
-    elif len(self) == 1: #As gabriel mention the edge case when len is 1
-      head = self.head #set the head to the current head
-      self.head = None #the head and tail will be None if the len is 1
-      self.tail = None
-      self.remainingSpace += head.value.size #same logic as mruEvict we add the value to remainingSpace
-      self.numItems -= 1  #subtract 1 from the numItems
-      return None
-    else:
-      previous = None  #In a double link list we set a previous and a head to literate through the link list
-      current_tail = self.tail #this current_head is the head
-
-      
-      previous = current_tail.previous #unlink the previous value by setting the next to None
-      previous.next = None
-
-      self.tail = previous #set the tail reference to the previous value
-      self.remainingSpace += current_tail.value.size  #same reason I explain earlier
-      self.numItems -= 1  #same reason i explain earlier
+    self._evict(self.tail, LRUPolicy)  #the tail is the least recently used
 
   
 
+  def verify(self):
+    used = 0  #walk the whole list once and check the links, the index and the space all agree
+    count = 0
+    previous = None
+    current = self.head
+    while current is not None:
+      if current.previous is not previous or self.index.get(current.value.cid) is not current:
+        return False
+      used += current.value.size
+      count += 1
+      previous = current
+      current = current.next
+    return previous is self.tail and count == self.numItems == len(self.index) and self.remainingSpace == self.maxSize - used
+
   def clear(self): #revise
     self.remainingSpace = self.maxSize #when clearing, there is no space being use so it will remain space will be the max possible space avalible
     self.numItems = 0  #the number of item is 0 since we clearing everything
     self.tail = None #in a link-list when both head and tail are None it means the link list is empty so I set the tail to None then head to None
     self.head = None
+    self.index = {}  #nothing in the list so nothing in the index
+    self.wheel = None
+    self.policy.reset()
+    if self.admission is not None:
+      self.admission.reset()
     return f'Cleared cache!'   #return 'Cleared cache!' when this function is called
 
 
+class CompactNode:
+  #a view of one slot of a CompactCacheList, made on demand so the list itself keeps no object per item
+  __slots__ = ('owner', 'slot', 'cid', 'value')
+
+  def __init__(self, owner, slot):
+    self.owner = owner
+    self.slot = slot
+    self.cid = owner.cids[slot]
+    self.value = owner._content(slot)  #a copy of the content as it was when the view was made
+
+  @property
+  def next(self):
+    return self.owner._at(self.owner.nexts[self.slot])
+
+  @property
+  def previous(self):
+    return self.owner._at(self.owner.prevs[self.slot])
+
+  @property
+  def expires(self):
+    expires = self.owner.expiry[self.slot]
+    return None if math.isnan(expires) else expires
+
+  def __eq__(self, other):  #two views are the same node when they point at the same slot holding the same cid
+    return isinstance(other, CompactNode) and self.owner is other.owner and self.slot == other.slot and self.cid == other.cid
+
+  def __hash__(self):
+    return hash((id(self.owner), self.slot))
+
+  def __str__(self):
+    return ('CONTENT:{}\n'.format(self.value))
+
+  __repr__ = __str__
+
+
+class CompactCacheList(CacheList):
+  '''
+    CacheList that keeps its entries in preallocated parallel arrays instead of Node and
+    ContentItem objects. Each field has its own array: links, sizes, expiry times, cids,
+    headers, contents and ttls. Entries are linked by slot number and freed slots go on a
+    free list. The arrays double when the slots run out. Nodes handed out are CompactNode views
+    made on demand, and their value is a ContentItem rebuilt from the slot. Only lru and mru
+    work here, because the other policies keep state per node.
+
+    >>> lst = CompactCacheList(30, slots=2)
+    >>> for cid in range(4):
+    ...     _ = lst.put(ContentItem(cid, 10, "compact", cid))
+    >>> [item.cid for item in lst], lst.get(1).value.cid, [item.cid for item in lst]
+    ([3, 2, 1], 1, [1, 3, 2])
+    >>> lst.tail.value
+    CONTENT ID: 2 SIZE: 10 HEADER: compact CONTENT: 2
+    >>> lst.tail.previous == lst.head.next
+    True
+    >>> lst.remove(3).cid, len(lst), len(lst.cids), lst.verify()
+    (3, 2, 4, True)
+    >>> CompactCacheList(30, 'lfu')
+    Traceback (most recent call last):
+    ...
+    ValueError: CompactCacheList keeps no per item policy state, use lru or mru
+  '''
+
+  def __init__(self, size, policy='lru', ttl=None, clock=time.monotonic, tick=1.0, admission=None, slots=1024):
+    self.first = self.last = -1  #slot of the head and the tail, -1 when there is none
+    self._allocate(max(1, slots))
+    super().__init__(size, policy, ttl=ttl, clock=clock, tick=tick, admission=admission)
+    if not self.policy.stateless:
+      raise ValueError('CompactCacheList keeps no per item policy state, use lru or mru')
+
+  def _allocate(self, slots):
+    self.nexts = array.array('i', [-1]) * slots
+    self.prevs = array.array('i', [-1]) * slots
+    self.sizes = array.array('q', [0]) * slots
+    self.expiry = array.array('d', [math.nan]) * slots  #nan never expires
+    self.cids = [None] * slots
+    self.headers = [None] * slots
+    self.contents = [None] * slots
+    self.ttls = [None] * slots
+    self.free = array.array('i', range(slots - 1, -1, -1))  #unused slots, the lowest is popped first
+
+  def _grow(self):
+    slots = len(self.cids)
+    self.nexts.extend(array.array('i', [-1]) * slots)
+    self.prevs.extend(array.array('i', [-1]) * slots)
+    self.sizes.extend(array.array('q', [0]) * slots)
+    self.expiry.extend(array.array('d', [math.nan]) * slots)
+    for column in (self.cids, self.headers, self.contents, self.ttls):
+      column.extend([None] * slots)
+    self.free.extend(range(2 * slots - 1, slots - 1, -1))
+
+  def _content(self, slot):
+    return ContentItem(self.cids[slot], self.sizes[slot], self.headers[slot], self.contents[slot], self.ttls[slot])
+
+  def _store(self, slot, content):
+    self.cids[slot] = content.cid
+    self.sizes[slot] = content.size
+    self.headers[slot] = content.header
+    self.contents[slot] = content.content
+    self.ttls[slot] = content.ttl
+
+  def _at(self, slot):
+    return None if slot < 0 else CompactNode(self, slot)
+
+  @property
+  def head(self):
+    return self._at(self.first)
+
+  @head.setter
+  def head(self, node):
+    self.first = -1 if node is None else node.slot
+
+  @property
+  def tail(self):
+    return self._at(self.last)
+
+  @tail.setter
+  def tail(self, node):
+    self.last = -1 if node is None else node.slot
+
+  def __iter__(self):
+    slot = self.first
+    while slot >= 0:
+      yield self._content(slot)
+      slot = self.nexts[slot]
+
+  def _node(self, cid):
+    slot = self.index.get(cid)  #the index maps cid -> slot
+    return None if slot is None else CompactNode(self, slot)
+
+  def holds(self, node):
+    return node.owner is self and self.index.get(node.cid) == node.slot
+
+  def setPolicy(self, policy):
+    if not make_policy(policy).stateless:
+      raise ValueError('CompactCacheList keeps no per item policy state, use lru or mru')
+    super().setPolicy(policy)
+
+  def _link(self, content, expires=None, atTail=False):
+    if not self.free:
+      self._grow()
+    slot = self.free.pop()
+    self._store(slot, content)
+    if self.first < 0:
+      self.nexts[slot] = self.prevs[slot] = -1
+      self.first = self.last = slot
+    elif atTail:
+      self.prevs[slot] = self.last
+      self.nexts[slot] = -1
+      self.nexts[self.last] = slot
+      self.last = slot
+    else:
+      self.nexts[slot] = self.first
+      self.prevs[slot] = -1
+      self.prevs[self.first] = slot
+      self.first = slot
+
+    self.index[content.cid] = slot
+    self.remainingSpace -= content.size
+    self.numItems += 1
+    if self.stats is not None:
+      self.stats.inserts += 1
+
+    ttl = content.ttl if content.ttl is not None else self.ttl
+    if expires is None and ttl is not None:
+      expires = self.clock() + ttl
+    self.expiry[slot] = math.nan if expires is None else expires
+    if expires is not None:
+      if self.wheel is None:
+        self.wheel = TimingWheel(self.tick, now=self.clock())
+      self.wheel.schedule((slot, content.cid), expires)  #a tuple, not a view, so waiting entries stay small
+
+  def _splice(self, slot):
+    previous, following = self.prevs[slot], self.nexts[slot]
+    if previous >= 0:
+      self.nexts[previous] = following
+    else:
+      self.first = following
+    if following >= 0:
+      self.prevs[following] = previous
+    else:
+      self.last = previous
+
+  def _front(self, slot):
+    if slot != self.first:  #lru and mru only need the order, no policy to tell
+      self._splice(slot)
+      self.nexts[slot] = self.first
+      self.prevs[slot] = -1
+      self.prevs[self.first] = slot
+      self.first = slot
+
+  def _touch(self, node):
+    self._front(node.slot)
+
+  def _unlink(self, node):
+    slot = node.slot
+    self._splice(slot)
+    detached = Node(self._content(slot))  #the slot gets reused, whoever gets the node back gets a standalone one
+    detached.expires = node.expires
+    del self.index[self.cids[slot]]
+    self.remainingSpace += self.sizes[slot]
+    self.numItems -= 1
+    self.cids[slot] = self.headers[slot] = self.contents[slot] = self.ttls[slot] = None
+    self.free.append(slot)
+    return detached
+
+  def expire(self, now=None):
+    if self.wheel is None:
+      return 0
+    now = self.clock() if now is None else now
+    expired = 0
+    for slot, cid in self.wheel.advance(now):
+      if self.index.get(cid) == slot and self.expiry[slot] <= now:  #nan compares false, so never expiring slots stay
+        self._unlink(CompactNode(self, slot))
+        expired += 1
+    if self.stats is not None:
+      self.stats.expired += expired
+    return expired
+
+  def update(self, cid, content):
+    slot = self.index.get(cid)
+    if slot is None or (content.cid != cid and content.cid in self.index):  #same rule as CacheList.update
+      return 'Cache miss!'
+    previous = self.sizes[slot]
+    if content.size > self.remainingSpace + previous:  #same rule as CacheList.update
+      return 'Cache miss!'
+    self.remainingSpace += previous - content.size
+    self._store(slot, content)
+    if content.cid != cid:
+      del self.index[cid]
+      self.index[content.cid] = slot
+    self._front(slot)
+    if self.stats is not None:
+      self.stats.updates += 1
+    return f'UPDATED: {content}'
+
+  def verify(self):
+    used = count = 0
+    previous = -1
+    slot = self.first
+    while slot >= 0:
+      if self.prevs[slot] != previous or self.index.get(self.cids[slot]) != slot:
+        return False
+      used += self.sizes[slot]
+      count += 1
+      previous = slot
+      slot = self.nexts[slot]
+    return (previous == self.last and count == self.numItems == len(self.index) and self.remainingSpace == self.maxSize - used
+            and count + len(self.free) == len(self.cids))
+
+  def clear(self):
+    self._allocate(len(self.cids))
+    return super().clear()
+
+
+def encode_payload(payload):
+  #(kind, data) for keeping a payload as bytes outside the heap: 's' utf-8 text, 'b' raw bytes, 'p' pickled object
+  if isinstance(payload, str):
+    return 's', payload.encode('utf-8')
+  if isinstance(payload, (bytes, bytearray, memoryview)):
+    return 'b', payload
+  return 'p', pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_payload(kind, data):
+  if kind == 's':
+    return str(data, 'utf-8')
+  if kind == 'b':
+    return bytes(data)
+  return pickle.loads(data)
+
+
+CODECS = {
+  'zlib': (zlib.compress, zlib.decompress),
+  'lzma': (lzma.compress, lzma.decompress),  #slower but tighter, meant for a cold level
+}
+
+
+class CompressedContentItem(ContentItem):
+  #what a CompressedCacheList keeps for one item: the metadata and the compressed payload
+  __slots__ = ('declared', 'codec', 'kind', 'blob', 'payload', 'store')
+  __hash__ = object.__hash__  #the hot set keys items by identity
+
+  def __init__(self, cid, size, declared, header, ttl, codec, kind, blob, store):
+    self.cid = cid
+    self.size = size  #what the list is charged: the declared size scaled by the compression ratio
+    self.declared = declared  #the size the caller gave, materialize hands it back
+    self.header = header
+    self.ttl = ttl
+    self.codec = codec
+    self.kind = kind  #how encode_payload stored it
+    self.blob = blob
+    self.payload = None  #the decompressed payload while the item is in the hot set of its list
+    self.store = store
+
+  def decompress(self):
+    return decode_payload(self.kind, CODECS[self.codec][1](self.blob))
+
+  @property
+  def content(self):
+    payload = self.payload
+    if payload is None:  #decompressed on the first read, the hot set keeps it around for the next ones
+      payload = self.decompress()
+    self.store.warm(self, payload)
+    return payload
+
+  def materialize(self):
+    payload = self.payload
+    return ContentItem(self.cid, self.declared, self.header, self.decompress() if payload is None else payload, self.ttl)
+
+  def __str__(self):
+    return str(self.materialize())
+
+  __repr__ = __str__
+
+
+class CompressedCacheList(CacheList):
+  '''
+    CacheList that compresses str, bytes and pickled payloads of at least threshold bytes with
+    codec ('zlib' or 'lzma') and charges remainingSpace for the declared size scaled by the
+    compression ratio, so a level sized in bytes is charged for the bytes it really holds.
+    Payloads that are smaller or don't shrink are kept as they are. Reading content decompresses
+    it lazily, and the last hotItems payloads read stay decompressed.
+
+    >>> lst = CompressedCacheList(1000, threshold=64)
+    >>> page = "<html><p>'CMPSC132'</p></html>" * 20
+    >>> lst.put(ContentItem(1005, 600, "Content-Type: 2", page))[:60]
+    'INSERTED: CONTENT ID: 1005 SIZE: 600 HEADER: Content-Type: 2'
+    >>> lst.put(ContentItem(1000, 10, "Content-Type: 0", "0xA"))
+    'INSERTED: CONTENT ID: 1000 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 0xA'
+    >>> stored = lst.index[1005].value.size  #600 scaled by what zlib made of the page
+    >>> stored < 100, lst.remainingSpace == 1000 - 10 - stored
+    (True, True)
+    >>> lst.get(1005).value.content == page, len(lst.hot)
+    (True, 1)
+    >>> lst.remove(1005).size, lst.verify()
+    (600, True)
+  '''
+
+  def __init__(self, size, policy='lru', ttl=None, clock=time.monotonic, tick=1.0, admission=None, codec='zlib', threshold=256, hotItems=32):
+    if codec not in CODECS:
+      raise ValueError(f'Unknown codec {codec}')
+    super().__init__(size, policy, ttl=ttl, clock=clock, tick=tick, admission=admission)
+    self.codec = codec
+    self.threshold = threshold
+    self.hotItems = hotItems
+    self.hot = OrderedDict()  #CompressedContentItem -> None, oldest first
+    self.hotLock = threading.Lock()  #content is read outside the shard locks
+
+  def warm(self, item, payload):
+    if self.hotItems <= 0:
+      return
+    with self.hotLock:
+      if item.payload is None:
+        item.payload = payload
+        self.hot[item] = None
+        if len(self.hot) > self.hotItems:
+          coldest, _ = self.hot.popitem(last=False)
+          coldest.payload = None  #back to decompressing on every read
+      elif item in self.hot:
+        self.hot.move_to_end(item)
+
+  def _pack(self, content):
+    if isinstance(content, CompressedContentItem):
+      if content.codec == self.codec:  #compressed with our codec already, only the hot set owner changes
+        return content if content.store is self else CompressedContentItem(content.cid, content.size, content.declared, content.header, content.ttl, content.codec, content.kind, content.blob, self)
+      content = content.materialize()
+    else:
+      content = content.materialize()  #a disk item brings its payload back into memory first
+    kind, raw = encode_payload(content.content)
+    if len(raw) < self.threshold:
+      return content
+    blob = CODECS[self.codec][0](raw)
+    if len(blob) >= len(raw):  #incompressible, keeping it raw is cheaper to read
+      return content
+    size = -(-content.size * len(blob) // len(raw))
+    return CompressedContentItem(content.cid, size, content.size, content.header, content.ttl, self.codec, kind, blob, self)
+
+  def put(self, content, evictionPolicy=None, expires=None, admit=True):
+    return super().put(self._pack(content), evictionPolicy, expires, admit)  #pack first so the eviction makes room for the compressed size
+
+  def put_many(self, contents, evictionPolicy=None, expires=None):
+    return super().put_many([self._pack(content) for content in contents], evictionPolicy, expires)
+
+  def update(self, cid, content):
+    return super().update(cid, self._pack(content))
+
+  def _link(self, content, expires=None, atTail=False):
+    if atTail:  #snapshot restores link directly, put and put_many have packed their content already
+      content = self._pack(content)
+    return super()._link(content, expires, atTail)
+
+  def remove(self, cid):
+    content = super().remove(cid)
+    return None if content is None else content.materialize()
+
+  def clear(self):
+    with self.hotLock:
+      for item in self.hot:
+        item.payload = None
+      self.hot.clear()
+    return super().clear()
+
+
+class DiskContentItem(ContentItem):
+  #what a DiskCacheList keeps in memory for one item: the metadata and where the payload sits on disk
+  __slots__ = ('store', 'kind', 'segment', 'offset', 'length')
+  __hash__ = object.__hash__  #segments key their records by identity, the header hash would put them all in 3 buckets
+
+  def __init__(self, cid, size, header, ttl, store, kind):
+    self.cid = cid
+    self.size = size
+    self.header = header
+    self.ttl = ttl
+    self.store = store
+    self.kind = kind  #how encode_payload stored it
+    self.segment = None
+    self.offset = 0
+    self.length = 0
+
+  @property
+  def content(self):
+    return self.store.view(self)  #a memoryview straight into the mmap, nothing is copied
+
+  def materialize(self):
+    payload = decode_payload(self.kind, self.store.view(self))  #copy it off the disk, for moving it into a memory level
+    return ContentItem(self.cid, self.size, self.header, payload, self.ttl)
+
+  def __str__(self):
+    return str(self.materialize())
+
+  __repr__ = __str__
+
+
+class _Segment:
+  #one append-only segment file mapped into memory
+  def __init__(self, number, path, capacity):
+    self.number = number
+    self.path = path
+    self.file = open(path, 'w+b')
+    self.file.truncate(capacity)  #allocate it up front so the map never has to grow
+    self.map = mmap.mmap(self.file.fileno(), capacity)
+    self.capacity = capacity
+    self.used = 0  #append offset
+    self.live = 0  #bytes still referenced by some item
+    self.items = {}  #DiskContentItem -> None for every live record in here
+
+  def close(self):
+    try:
+      self.map.close()
+    except BufferError:  #somebody still holds a memoryview, the map goes when they let go of it
+      pass
+    self.file.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+class DiskCacheList(CacheList):
+  '''
+    CacheList for the last level that keeps only the index and recency links in memory. Payloads
+    are appended to mmap'd segment files and read back as memoryview slices, without copying.
+    When a full segment drops under compactRatio live bytes its records are copied forward and
+    the file is deleted.
+
+    >>> import tempfile
+    >>> lst = DiskCacheList(100, directory=tempfile.mkdtemp(), segmentSize=64)
+    >>> for cid in range(6):
+    ...     _ = lst.put(ContentItem(cid, 10, "disk", "payload-%d" % cid * 2))
+    >>> bytes(lst.read(3))
+    b'payload-3payload-3'
+    >>> lst.index[4].value.content.obj is lst.segments[lst.index[4].value.segment].map
+    True
+    >>> lst.index[5].value
+    CONTENT ID: 5 SIZE: 10 HEADER: disk CONTENT: payload-5payload-5
+    >>> sorted(lst.segments)
+    [0, 1]
+    >>> for cid in range(2):
+    ...     _ = lst.remove(cid)
+    >>> sorted(os.listdir(lst.directory)), bytes(lst.read(2))
+    (['segment-000001.dat', 'segment-000002.dat'], b'payload-2payload-2')
+    >>> lst.verify()
+    True
+    >>> seen = []
+    >>> lst.enableStats().listeners['evict'].append(lambda cachelist, content: seen.append(bytes(content.content)))
+    >>> for cid in range(6, 18):
+    ...     _ = lst.put(ContentItem(cid, 10, "disk", "payload-%d" % cid * 2))
+    >>> seen[:2]
+    [b'payload-2payload-2', b'payload-3payload-3']
+    >>> lst.close()
+  '''
+
+  def __init__(self, size, policy='lru', ttl=None, clock=time.monotonic, tick=1.0, admission=None, directory=None, segmentSize=64 << 20, compactRatio=0.5):
+    super().__init__(size, policy, ttl=ttl, clock=clock, tick=tick, admission=admission)
+    self.directory = tempfile.mkdtemp(prefix='cachelist-') if directory is None else directory
+    os.makedirs(self.directory, exist_ok=True)
+    self.segmentSize = segmentSize
+    self.compactRatio = compactRatio
+    self.segments = {}  #segment number -> _Segment
+    self.active = None  #segment new records are appended to
+    self.nextSegment = 0
+
+  def _newSegment(self, capacity):
+    number = self.nextSegment
+    self.nextSegment += 1
+    segment = _Segment(number, os.path.join(self.directory, f'segment-{number:06d}.dat'), capacity)
+    self.segments[number] = segment
+    return segment
+
+  def _append(self, item, data):
+    length = len(data)
+    segment = self.active
+    previous = None
+    if segment is None or segment.used + length > segment.capacity:
+      if length > self.segmentSize:  #an item bigger than a segment gets a segment of its own
+        segment = self._newSegment(length)
+      else:
+        previous = self.active
+        segment = self.active = self._newSegment(self.segmentSize)
+    segment.map[segment.used:segment.used + length] = data
+    item.segment, item.offset, item.length = segment.number, segment.used, length
+    segment.used += length
+    segment.live += length
+    segment.items[item] = None
+    if previous is not None:  #a segment can only be compacted once nothing is appended to it
+      self._maybeCompact(previous)
+
+  def _release(self, item):
+    segment = self.segments[item.segment]
+    del segment.items[item]
+    segment.live -= item.length
+    self._maybeCompact(segment)
+
+  def _maybeCompact(self, segment):
+    if segment is self.active or segment.live > self.compactRatio * segment.capacity:
+      return
+    for item in list(segment.items):  #copy the live records forward, then the whole file goes
+      self._append(item, segment.map[item.offset:item.offset + item.length])
+    del self.segments[segment.number]
+    segment.close()
+
+  def _store(self, content):
+    if isinstance(content, DiskContentItem):
+      content = content.materialize()
+    kind, data = encode_payload(content.content)
+    item = DiskContentItem(content.cid, content.size, content.header, content.ttl, self, kind)
+    self._append(item, data)
+    return item
+
+  def view(self, item):
+    return memoryview(self.segments[item.segment].map)[item.offset:item.offset + item.length]
+
+  def read(self, cid):
+    node = self.find(cid)  #no recency change, just hand out the bytes
+    return None if node is None else node.value.content
+
+  def _link(self, content, expires=None, atTail=False):
+    return super()._link(self._store(content), expires, atTail)
+
+  def _unlink(self, node):
+    super()._unlink(node)
+    self._release(node.value)
+    return node
+
+  def _evict(self, node, policy=None):
+    CacheList._unlink(self, node)  #keep the record until the listeners and the next level have read it
+    self._evicted(node, policy)
+    self._release(node.value)
+    return node
+
+  def remove(self, cid):
+    node = self.index.get(cid)
+    if node is None:
+      return None
+    content = node.value.materialize()  #copy it out before the record can be compacted away
+    self._unlink(node)
+    return content
+
+  def update(self, cid, content):
+    node = self.index.get(cid)
+    if node is None:
+      return 'Cache miss!'
+    if content is node.value:  #updating with the same content is only a touch, there is nothing new to write
+      return super().update(cid, content)
+    old = node.value
+    item = self._store(content)
+    result = super().update(cid, item)
+    if node.value is item:  #the new payload is in, the old record is dead
+      self._release(old)
+      return f'UPDATED: {content}'
+    self._release(item)
+    return result
+
+  def clear(self):
+    for segment in self.segments.values():
+      segment.close()
+    self.segments = {}
+    self.active = None
+    return super().clear()
+
+  def close(self):
+    self.clear()
+    if os.path.isdir(self.directory) and not os.listdir(self.directory):
+      os.rmdir(self.directory)
+
+
+SNAPSHOT_MAGIC = b'MLCS'
+SNAPSHOT_VERSION = 2  #2 adds the layout the lists were routed by, 1 is still read
+
+
+class _SnapshotWriter:
+  #writes tagged values and keeps a running crc32 of everything after the magic
+  def __init__(self, stream):
+    self.stream = stream
+    self.crc = 0
+
+  def write(self, data):
+    self.crc = zlib.crc32(data, self.crc)
+    self.stream.write(data)
+
+  def pack(self, fmt, *values):
+    self.write(struct.pack(fmt, *values))
+
+  def blob(self, tag, data):
+    self.pack('<BI', tag, len(data))
+    self.write(data)
+
+  def value(self, value):
+    if value is None:
+      self.pack('<B', 0)
+    elif isinstance(value, bool) or not isinstance(value, (int, str, bytes, bytearray, memoryview, float)):
+      self.blob(5, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    elif isinstance(value, int):
+      if -(1 << 63) <= value < (1 << 63):
+        self.pack('<Bq', 1, value)
+      else:
+        self.blob(5, pickle.dumps(value))
+    elif isinstance(value, str):
+      self.blob(2, value.encode('utf-8'))
+    elif isinstance(value, float):
+      self.pack('<Bd', 4, value)
+    else:
+      self.blob(3, value)
+
+
+class _SnapshotReader:
+  def __init__(self, stream):
+    self.stream = stream
+    self.crc = 0
+
+  def read(self, size):
+    data = self.stream.read(size)
+    if len(data) != size:
+      raise ValueError('snapshot is truncated')
+    self.crc = zlib.crc32(data, self.crc)
+    return data
+
+  def unpack(self, fmt):
+    return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+  def value(self):
+    tag, = self.unpack('<B')
+    if tag == 0:
+      return None
+    if tag == 1:
+      return self.unpack('<q')[0]
+    if tag == 4:
+      return self.unpack('<d')[0]
+    length, = self.unpack('<I')
+    data = self.read(length)
+    if tag == 2:
+      return str(data, 'utf-8')
+    if tag == 3:
+      return data
+    if tag == 5:
+      return pickle.loads(data)
+    raise ValueError(f'unknown value tag {tag} in snapshot')
+
+
+class Evictor:
+  '''
+    Runs reclaim for the lists that went over their high watermark on a daemon thread, so
+    inserts find the room already made. It also wakes every interval seconds in case a
+    notification went missing. With thread=False nothing starts and run() does one pass from
+    wherever the caller likes, an asyncio task for instance. reclaim is a method of the owner and
+    is held weakly, so the thread never keeps the owner alive and stops once it is collected.
+
+    >>> import gc
+    >>> cache = Cache(100, shards=2, watermarks=(0.9, 0.6))
+    >>> evictor = cache.evictor
+    >>> del cache
+    >>> _ = gc.collect()
+    >>> evictor.thread.join(1)
+    >>> evictor.stopped, evictor.thread.is_alive()
+    (True, False)
+    >>> with Cache(100, shards=2, watermarks=(0.9, 0.6)) as cache:
+    ...     thread = cache.evictor.thread
+    >>> thread.is_alive()
+    False
+  '''
+
+  def __init__(self, reclaim, interval=0.05, thread=True):
+    self.reclaim = weakref.WeakMethod(reclaim)  #reclaim(cachelist) -> items evicted, the owner takes whatever locks it needs
+    self.interval = interval
+    self.pending = deque()  #weak references to lists that reported pressure, deque appends and pops are thread safe
+    self.wake = threading.Event()
+    self.stopped = False
+    self.passes = 0
+    self.thread = None
+    if thread:
+      self.thread = threading.Thread(target=self._loop, name='cache-evictor', daemon=True)
+      self.thread.start()
+
+  def notify(self, cachelist):
+    self.pending.append(weakref.ref(cachelist))  #a list links back to its owner, a strong one here would keep the owner alive
+    self.wake.set()
+
+  def run(self):
+    evicted = 0
+    reclaim = self.reclaim()
+    if reclaim is None:  #the owner was collected without close()
+      self.stopped = True
+      self.pending.clear()
+      return evicted
+    while True:
+      try:
+        cachelist = self.pending.popleft()()
+      except IndexError:  #another thread took the last one
+        break
+      if cachelist is not None:
+        evicted += reclaim(cachelist)
+    self.passes += 1
+    return evicted
+
+  def _loop(self):
+    while not self.stopped:
+      self.wake.wait(self.interval)
+      self.wake.clear()
+      self.run()
+
+  def stop(self):
+    self.stopped = True
+    self.wake.set()
+    if self.thread is not None and self.thread is not threading.current_thread():
+      self.thread.join()
+
+
+class _ShardLock:
+  #holds the lock of the shard content routes to, routed again if a reshard got in while we waited for the lock
+  __slots__ = ('cache', 'content', 'lock')
+
+  def __init__(self, cache, content):
+    self.cache = cache
+    self.content = content
+    self.lock = None
+
+  def __enter__(self):
+    cache = self.cache
+    while True:
+      generation = cache.generation
+      if generation & 1:  #a reshard is moving keys and holds lock 0 until it is done
+        with cache.locks[0]:
+          continue
+      shard = cache._shardOf(self.content)
+      locks = cache.locks
+      if shard < len(locks):
+        lock = locks[shard]
+        lock.__enter__()
+        if cache.generation == generation:
+          self.lock = lock
+          return shard
+        lock.__exit__(None, None, None)
+
+  def __exit__(self, *exc):
+    return self.lock.__exit__(*exc)
+
+
 class Cache:
     """
         >>> cache = Cache(205)
@@ -454,55 +2272,1040 @@ class Cache:
         True
         >>> cache.hierarchy[2].tail.previous.previous.previous is None
         True
+
+        In a tiered cache new content goes to L1, evicted content is demoted a level and a hit
+        below L1 promotes it back up.
+
+        >>> tiered = Cache(20, mode='exclusive')
+        >>> [level.maxSize for level in tiered.hierarchy]
+        [20, 40, 80]
+        >>> for cid in range(1, 6):
+        ...     _ = tiered.insert(ContentItem(cid, 10, "Content-Type: 0", cid))
+        >>> [sorted(level.index) for level in tiered.hierarchy]
+        [[4, 5], [1, 2, 3], []]
+        >>> tiered[ContentItem(1, 10, "Content-Type: 0", 1)].value
+        CONTENT ID: 1 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 1
+        >>> [sorted(level.index) for level in tiered.hierarchy]
+        [[1, 5], [2, 3, 4], []]
+        >>> inclusive = Cache(20, mode='inclusive', capacities=[20, 30, 40])
+        >>> for cid in range(1, 6):
+        ...     _ = inclusive.insert(ContentItem(cid, 10, "Content-Type: 0", cid))
+        >>> [sorted(level.index) for level in inclusive.hierarchy]
+        [[4, 5], [3, 4, 5], [2, 3, 4, 5]]
+        >>> inclusive[ContentItem(2, 10, "Content-Type: 0", 2)].value
+        CONTENT ID: 2 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 2
+        >>> [sorted(level.index) for level in inclusive.hierarchy]
+        [[2, 5], [2, 4, 5], [2, 3, 4, 5]]
+
+        With shards= the lists are picked by a hash of the cid instead of the header, and
+        jump hashing keeps most keys in place when the shard count changes.
+
+        >>> sharded = Cache(1000, shards=4)
+        >>> for cid in range(400):
+        ...     _ = sharded.insert(ContentItem(cid, 1, "Content-Type: 0", cid))
+        >>> [row['items'] for row in sharded.occupancy()]
+        [96, 111, 83, 110]
+        >>> before = {cid: i for i, lst in enumerate(sharded.hierarchy) for cid in lst.index}
+        >>> [row['items'] for row in sharded.reshard(5)]
+        [76, 94, 66, 102, 62]
+        >>> sum(before[cid] != i for i, lst in enumerate(sharded.hierarchy) for cid in lst.index)
+        62
+        >>> sharded[ContentItem(7, 1, "Content-Type: 0", 7)].value
+        CONTENT ID: 7 SIZE: 1 HEADER: Content-Type: 0 CONTENT: 7
+
+        Moves bypass admission filters, content the cache already took is never turned away.
+
+        >>> guarded = Cache(100, mode='exclusive', shards=4, admission='tinylfu')
+        >>> _ = guarded.insert_many([ContentItem(cid, 10, "Content-Type: 0", cid) for cid in range(30)])
+        >>> [row['items'] for row in guarded.reshard(1)], [len(level) for level in guarded.hierarchy]
+        ([30], [10, 20, 0])
+
+        concurrent=True gives every shard its own lock. Hits in the top list are answered from
+        the index and their promotion is buffered, so readers rarely wait for a writer.
+
+        >>> import random
+        >>> shared = Cache(300, 'lfu', mode='exclusive', shards=4, concurrent=True)
+        >>> def worker(seed):
+        ...     rng = random.Random(seed)
+        ...     for _ in range(3000):
+        ...         cid = int(rng.paretovariate(1.2)) % 500
+        ...         item = ContentItem(cid, rng.randint(1, 20), "Content-Type: 0", cid)
+        ...         if shared[item] == 'Cache miss!':
+        ...             _ = shared.insert(item)
+        >>> workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+        >>> for thread in workers:
+        ...     thread.start()
+        >>> for thread in workers:
+        ...     thread.join()
+        >>> all(cachelist.verify() for cachelist in shared.hierarchy)
+        True
+        >>> packed = Cache(200, shards=1, concurrent=True, compact=True)
+        >>> wrong = []
+        >>> def writer(seed):
+        ...     rng = random.Random(seed)
+        ...     for _ in range(5000):
+        ...         cid = rng.randrange(2000)
+        ...         if packed.insert(ContentItem(cid, 1, "Content-Type: 0", cid)).startswith('Content'):
+        ...             _ = packed.remove(cid)
+        >>> def reader(seed):
+        ...     rng = random.Random(seed)
+        ...     for _ in range(5000):
+        ...         cid = rng.randrange(2000)
+        ...         node = packed[ContentItem(cid, 1, "Content-Type: 0", None)]
+        ...         if node != 'Cache miss!' and node.value.cid != cid:
+        ...             wrong.append((cid, node.value.cid))
+        >>> workers = [threading.Thread(target=work, args=(seed,)) for seed in range(3) for work in (writer, reader)]
+        >>> for thread in workers:
+        ...     thread.start()
+        >>> for thread in workers:
+        ...     thread.join()
+        >>> wrong, all(cachelist.verify() for cachelist in packed.hierarchy)
+        ([], True)
+
+        Content can carry its own ttl in seconds, otherwise defaultTtl applies. Stale content is a
+        miss straight away and the timing wheels reclaim it without walking the lists.
+
+        >>> now = [0.0]
+        >>> fresh = Cache(100, mode='exclusive', defaultTtl=10, clock=lambda: now[0])
+        >>> _ = fresh.insert(ContentItem(1, 10, "Content-Type: 0", "default ttl"))
+        >>> _ = fresh.insert(ContentItem(2, 10, "Content-Type: 0", "short", ttl=2))
+        >>> _ = fresh.insert(ContentItem(3, 10, "Content-Type: 0", "long", ttl=60))
+        >>> now[0] = 5
+        >>> fresh[ContentItem(2, 10, "Content-Type: 0", "")], fresh[ContentItem(1, 10, "Content-Type: 0", "")].value.content
+        ('Cache miss!', 'default ttl')
+        >>> now[0] = 30
+        >>> fresh.expire(), [sorted(level.index) for level in fresh.hierarchy]
+        (2, [[3], [], []])
+
+        disk= keeps the last level of a tiered cache in mmap'd segment files under that directory.
+
+        >>> import tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> ondisk = Cache(20, mode='exclusive', disk=root)
+        >>> for cid in range(10):
+        ...     _ = ondisk.insert(ContentItem(cid, 10, "Content-Type: 0", "page %d" % cid))
+        >>> type(ondisk.hierarchy[2]).__name__, sorted(ondisk.hierarchy[2].index)
+        ('DiskCacheList', [0, 1, 2, 3])
+        >>> bytes(ondisk.hierarchy[2].read(1))
+        b'page 1'
+        >>> ondisk[ContentItem(1, 10, "Content-Type: 0", "")].value
+        CONTENT ID: 1 SIZE: 10 HEADER: Content-Type: 0 CONTENT: page 1
+        >>> ondisk.hierarchy[0].index[1].value.content
+        'page 1'
+        >>> ondisk.close()
+        >>> os.listdir(root)
+        []
+        >>> spread = Cache(20, mode='exclusive', shards=4, disk=root)
+        >>> _ = spread.insert_many([ContentItem(cid, 10, "Content-Type: 0", "page %d" % cid) for cid in range(40)])
+        >>> len(os.listdir(root)), [row['items'] for row in spread.reshard(1)], len(os.listdir(root))
+        (4, [14], 1)
+        >>> spread.close()
+
+        admission= puts a TinyLFU filter in front of every list, or per level when it is a list.
+        Leaving L1 open lets it act as the window new content has to prove itself in.
+
+        >>> guarded = Cache(20, mode='exclusive', admission=[None, 'tinylfu', 'tinylfu'])
+        >>> [level.admission for level in guarded.hierarchy]
+        [None, TinyLFU, TinyLFU]
+
+        compression= compresses big payloads in every list, or per level when it is a list, and
+        charges the levels for the compressed size. L1 is usually left raw so hits stay cheap.
+
+        >>> packed = Cache(20, mode='exclusive', compression=[None, 'zlib', 'lzma'])
+        >>> [type(level).__name__ for level in packed.hierarchy]
+        ['CacheList', 'CompressedCacheList', 'CompressedCacheList']
+        >>> zipped = Cache(1000, compression='zlib')
+        >>> page = lambda cid: ContentItem(cid, 300, "Content-Type: 1", "<p>psu</p>" * 30)
+        >>> zipped.get_or_load(1, page).cid, zipped.get_or_load(1, page).cid, zipped.remove(1).cid
+        (1, 1, 1)
     """
 
-    def __init__(self, lst_capacity):
-        self.hierarchy = [CacheList(lst_capacity), CacheList(lst_capacity), CacheList(lst_capacity)]
-        self.size = 3
+    def __init__(self, lst_capacity, policies='lru', mode='partition', capacities=None, shards=None, keyHash=None, concurrent=False, readBuffer=64, negativeTtl=0, defaultTtl=None, clock=time.monotonic, disk=None, stats=False, latency=False, admission=None, compact=False, compression=None, watermarks=None, background=True, reclaimBatch=256):
+        if mode not in ('partition', 'exclusive', 'inclusive'):
+          raise ValueError(f'Unknown cache mode {mode}')
+        if capacities is None:  #partition mode splits keys over equal lists, the tiers grow towards L3
+          capacities = [lst_capacity] * 3 if mode == 'partition' else [lst_capacity, lst_capacity * 2, lst_capacity * 4]
+        self.mode = mode
+        self.policies = policies
+        self.capacities = capacities
+        self.keyHash = mix_hash if keyHash is None else keyHash
+        self.defaultTtl = defaultTtl
+        self.clock = clock
+        if disk is not None and mode == 'partition':
+          raise ValueError('disk= puts the last level of a tiered cache on disk, pick mode exclusive or inclusive')
+        self.disk = disk  #directory for the mmap'd L3 segments, None keeps every level in memory
+        self.instrumented = stats or latency
+        self.listeners = []  #(event, callback) every list gets, including lists made by reshard
+        self.latency = {'insert': LatencyHistogram(), 'get': LatencyHistogram()} if latency else None
+        self.compact = compact  #in memory levels are CompactCacheLists, lru and mru only
+        self.admission = admission  #admission filter for every list, or a list of them by level (by shard in partition mode)
+        self.compression = compression  #codec for every list, or a list of them by level, None keeps payloads as they are
+        self.watermarks = watermarks  #(high, low) fractions for every list, None leaves eviction to insert
+        self.reclaimBatch = reclaimBatch  #items the evictor takes out per hold of a shard lock, a put that finds the list full still evicts inline
+        self.evictor = None if watermarks is None else Evictor(self._reclaim, thread=background)
+        if self.evictor is not None:
+          weakref.finalize(self, self.evictor.stop)  #a cache dropped without close() still takes its thread with it
+        self.legacy = mode == 'partition' and shards is None  #the original 3 lists picked by ContentItem.__hash__
+        if mode == 'partition':  #every shard is a single list
+          self.shards = [[self._newList(capacities[i % len(capacities)], policy, admission=self._admission(i), compression=self._compression(i))] for i, policy in enumerate(self._policies(shards or 3))]
+        else:  #every shard is its own L1 -> L2 -> L3 chain
+          self.shards = [self._chain() for _ in range(shards or 1)]
+        self.hierarchy = [cachelist for chain in self.shards for cachelist in chain]
+        self.size = len(self.hierarchy)
+        self.admitting = any(cachelist.admission is not None for cachelist in self.hierarchy)
+        self.concurrent = concurrent
+        self.readBuffer = readBuffer
+        self.locks = [self._lock() for _ in self.shards]  #one lock per shard so threads on different shards never wait on each other
+        self.readBuffers = [deque(maxlen=readBuffer) for _ in self.shards]  #hits waiting to be replayed into the recency order
+        self.negativeTtl = negativeTtl  #seconds a failed load is remembered, 0 turns it off
+        self.generation = 0  #bumped when a reshard starts and again when it is done, odd while keys are moving
+        self.loadLock = threading.Lock()
+        self.inflight = {}  #cid -> Future of the load every caller missing on that cid waits for
+        self.asyncInflight = {}
+        self.failures = {}  #cid -> (expires, error) of recent failed loads
+        self.failureLimit = 64  #size at which expired failures are swept out, doubles with what is still live
+
+    def _lock(self):
+        return threading.RLock() if self.concurrent or self.evictor is not None else contextlib.nullcontext()  #the evictor thread needs real locks
+
+    def _drain(self, shard):
+        #replay buffered hits into L1 of the shard, the caller holds the shard lock
+        buffer = self.readBuffers[shard]
+        top = self.shards[shard][0]
+        while buffer:
+          node = buffer.popleft()
+          if top.holds(node):  #it may have been evicted or moved since the read
+            top._touch(node)
+
+    def _policies(self, count):
+        if isinstance(self.policies, (str, EvictionPolicy)):  #one policy for every list, each list gets its own copy
+          return [copy.copy(self.policies) for _ in range(count)]
+        return [copy.copy(self.policies[i % len(self.policies)]) for i in range(count)]
+
+    def _admission(self, level):
+        if isinstance(self.admission, (list, tuple)):
+          return self.admission[level % len(self.admission)]
+        return self.admission
+
+    def _compression(self, level):
+        if isinstance(self.compression, (list, tuple)):
+          return self.compression[level % len(self.compression)]
+        return self.compression
+
+    def _newList(self, capacity, policy, onDisk=False, admission=None, compression=None):
+        if onDisk:  #the disk level stores payloads as they are
+          cachelist = DiskCacheList(capacity, policy, ttl=self.defaultTtl, clock=self.clock, admission=admission, directory=tempfile.mkdtemp(prefix='shard-', dir=self.disk))
+        elif compression is not None:  #a compressed level keeps objects per item, so compact doesn't apply to it
+          cachelist = CompressedCacheList(capacity, policy, ttl=self.defaultTtl, clock=self.clock, admission=admission, codec=compression)
+        elif self.compact:
+          cachelist = CompactCacheList(capacity, policy, ttl=self.defaultTtl, clock=self.clock, admission=admission)
+        else:
+          cachelist = CacheList(capacity, policy, ttl=self.defaultTtl, clock=self.clock, admission=admission)
+        if self.watermarks is not None:
+          cachelist.setWatermarks(*self.watermarks)
+          cachelist.onPressure = self.evictor.notify
+        if self.instrumented:
+          cachelist.enableStats()
+          for event, callback in self.listeners:
+            cachelist.listen(event, callback)
+        return cachelist
+
+    def _chain(self):
+        last = len(self.capacities) - 1
+        chain = [self._newList(capacity, policy, self.disk is not None and level == last, self._admission(level), self._compression(level)) for level, (capacity, policy) in enumerate(zip(self.capacities, self._policies(len(self.capacities))))]
+        for level, cachelist in enumerate(chain):
+          cachelist.onEvict = functools.partial(self._demote, chain, level)
+        return chain
 
     def __str__(self):
-        return ('L1 CACHE:\n{}\nL2 CACHE:\n{}\nL3 CACHE:\n{}\n'.format(self.hierarchy[0], self.hierarchy[1], self.hierarchy[2]))
+        if self.legacy:
+          return ('L1 CACHE:\n{}\nL2 CACHE:\n{}\nL3 CACHE:\n{}\n'.format(self.hierarchy[0], self.hierarchy[1], self.hierarchy[2]))
+        if len(self.shards) == 1:
+          return ''.join(f'L{level + 1} CACHE:\n{cachelist}\n' for level, cachelist in enumerate(self.shards[0]))
+        return ''.join(f'SHARD {shard} L{level + 1} CACHE:\n{cachelist}\n' for shard, chain in enumerate(self.shards) for level, cachelist in enumerate(chain))
 
     __repr__=__str__
 
 
     def clear(self):
-      for item in self.hierarchy:
-        item.clear()
+      for shard, chain in enumerate(self.shards):
+        with self.locks[shard]:
+          self.readBuffers[shard].clear()
+          for item in chain:
+            item.clear()
       return 'Cache cleared!'
 
+    def expire(self):
+      expired = 0  #advance every timing wheel, the lists only ever touch the entries that are due
+      for shard, chain in enumerate(self.shards):
+        with self.locks[shard]:
+          for cachelist in chain:
+            expired += cachelist.expire()
+      return expired
+
+    def _shardOf(self, content, shards=None):
+      if self.legacy:
+        return ContentItem.__hash__(content) # As gabriel mention we trying to get the proper Cahcelist index by hashing the content.__hash__() and use thar index to access self.hierarchy
+      return jump_hash(self.keyHash(content.cid), len(self.shards if shards is None else shards))
 
-    def insert(self, content, evictionPolicy):
-      return self.hierarchy[content.__hash__()].put(content, evictionPolicy) # As gabriel mention we trying to get the proper Cahcelist index by hashing the content.__hash__() and use thar index to access self.hierarchy and apply put
+    def _route(self, content):
+      return self.shards[self._shardOf(content)]
+
+    def _batches(self, keys):
+      #yield (shard, positions of keys in it) with that shard locked, positions are grouped again when a reshard gets in between
+      pending = list(range(len(keys)))
+      while pending:
+        generation = self.generation
+        if generation & 1:
+          with self.locks[0]:
+            continue
+        groups = {}
+        for position in pending:
+          groups.setdefault(self._shardOf(keys[position]), []).append(position)
+        pending = []
+        for shard, positions in groups.items():
+          locks = self.locks
+          if shard >= len(locks):
+            pending.extend(positions)
+            continue
+          with locks[shard]:
+            if self.generation != generation:
+              pending.extend(positions)
+              continue
+            yield shard, positions
+
+    def _capture(self):
+      #copy references to every node, one shard lock at a time, so writing never blocks the whole cache
+      now = self.clock()
+      lists = []
+      for shard, chain in enumerate(self.shards):
+        with self.locks[shard]:
+          self._drain(shard)
+          for cachelist in chain:
+            records = []
+            current = cachelist.head
+            while current is not None:
+              content = current.value
+              if isinstance(content, CompressedContentItem):  #snapshots hold the payload and size the caller gave
+                content = content.materialize()
+              if isinstance(content, DiskContentItem):  #the view pins the map, so compaction can't pull it away mid write
+                payload = (content.kind, content.content)
+              else:
+                payload = (None, content.content)
+              remaining = math.nan if current.expires is None else current.expires - now
+              if not remaining <= 0:
+                records.append((content.cid, content.size, content.header, content.ttl, remaining, payload))
+              current = current.next
+            lists.append((cachelist.maxSize, records))
+      return lists
+
+    def _layout(self):
+      #everything that decides which list a cid lives in, lists are only relinked as they are into a cache that agrees on all of it
+      keyHash = f'{getattr(self.keyHash, "__module__", "")}.{getattr(self.keyHash, "__qualname__", type(self.keyHash).__qualname__)}'
+      return f'mode={self.mode} shards={len(self.shards)} legacy={self.legacy} hash={keyHash}'
+
+    def _write(self, path, lists, layout):
+      temporary = f'{path}.tmp'
+      with open(temporary, 'wb') as stream:
+        stream.write(SNAPSHOT_MAGIC)
+        out = _SnapshotWriter(stream)
+        out.pack('<HI', SNAPSHOT_VERSION, len(lists))
+        out.value(layout)
+        for maxSize, records in lists:
+          out.pack('<qQ', maxSize, len(records))
+          for cid, size, header, ttl, remaining, (kind, payload) in records:
+            out.value(cid)
+            out.pack('<qd', size, remaining)
+            out.value(header)
+            out.value(ttl)
+            if kind == 's':
+              out.blob(2, payload)  #disk payloads are already encoded, write the bytes as they are
+            elif kind == 'p':
+              out.blob(5, payload)
+            else:
+              out.value(payload)
+        stream.write(struct.pack('<I', out.crc))
+      os.replace(temporary, path)  #readers only ever see a complete snapshot
+
+    def save(self, path, background=False):
+      '''
+        Write every list head to tail into a versioned, crc32 checked binary snapshot. Shards are
+        copied one lock at a time and the file is written afterwards, with background=True on a
+        separate thread (the thread is returned so it can be joined).
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'cache.snapshot')
+        >>> cache = Cache(100, 'lfu', mode='exclusive', shards=2, defaultTtl=300)
+        >>> _ = cache.insert_many([ContentItem(cid, 10, "Content-Type: 0", "page %d" % cid) for cid in range(30)])
+        >>> _ = cache.insert(ContentItem(99, 5, "Content-Type: 1", {'any': 'object'}, ttl=30))
+        >>> cache.save(path, background=True).join()
+        >>> restored = Cache(100, 'lfu', mode='exclusive', shards=2)
+        >>> restored.load(path)
+        'Cache loaded!'
+        >>> [[item.cid for item in lst] for lst in restored.hierarchy] == [[item.cid for item in lst] for lst in cache.hierarchy]
+        True
+        >>> restored[ContentItem(99, 5, "", None)].value.content
+        {'any': 'object'}
+        >>> all(lst.verify() for lst in restored.hierarchy)
+        True
+
+        A snapshot of a differently shaped or differently sharded cache is inserted again coldest
+        first, so every cid lands in the shard it routes to and the hottest items still end up in
+        L1.
+
+        >>> tiers = Cache(10, mode='exclusive', capacities=[30, 60, 120], shards=1)
+        >>> _ = tiers.insert_many([ContentItem(cid, 10, "Content-Type: 0", cid) for cid in range(21)])
+        >>> tiers.save(path)
+        >>> wider = Cache(10, mode='exclusive', capacities=[30, 60, 130], shards=1)
+        >>> wider.load(path)
+        'Cache loaded!'
+        >>> [[item.cid for item in lst] for lst in wider.hierarchy]
+        [[20, 19, 18], [17, 16, 15, 14, 13, 12], [11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0]]
+        >>> legacy = Cache(100)
+        >>> _ = legacy.insert_many([ContentItem(cid, 10, "Content-Type: %d" % (cid % 3), cid) for cid in range(10)])
+        >>> legacy.save(path)
+        >>> sharded = Cache(100, shards=3)
+        >>> sharded.load(path)
+        'Cache loaded!'
+        >>> sum(sharded[ContentItem(cid, 10, "", None)] != 'Cache miss!' for cid in range(10)), sharded.insert(ContentItem(3, 10, "", 3))
+        (10, 'Content 3 already in cache, insertion not allowed')
+        >>> data = bytearray(open(path, 'rb').read())
+        >>> data[40] ^= 1
+        >>> _ = open(path, 'wb').write(data)
+        >>> restored.load(path)
+        Traceback (most recent call last):
+        ...
+        ValueError: snapshot checksum mismatch
+      '''
+      layout = self._layout()
+      lists = self._capture()
+      if not background:
+        self._write(path, lists, layout)
+        return None
+      writer = threading.Thread(target=self._write, args=(path, lists, layout), daemon=True)
+      writer.start()
+      return writer
+
+    def load(self, path):
+      now = self.clock()
+      with open(path, 'rb') as stream:
+        if stream.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+          raise ValueError('not a cache snapshot')
+        inp = _SnapshotReader(stream)
+        version, count = inp.unpack('<HI')
+        if version not in (1, SNAPSHOT_VERSION):
+          raise ValueError(f'unsupported snapshot version {version}')
+        layout = inp.value() if version > 1 else None  #a version 1 snapshot doesn't say how it was routed
+        lists = []
+        for _ in range(count):
+          maxSize, items = inp.unpack('<qQ')
+          records = []
+          for _ in range(items):
+            cid = inp.value()
+            size, remaining = inp.unpack('<qd')
+            header = inp.value()
+            ttl = inp.value()
+            content = inp.value()
+            records.append((ContentItem(cid, size, header, content, ttl), None if math.isnan(remaining) else now + remaining))
+          lists.append((maxSize, records))
+        trailer = stream.read(4)
+        if len(trailer) != 4:
+          raise ValueError('snapshot is truncated')
+        if struct.unpack('<I', trailer)[0] != inp.crc:  #nothing has been touched yet, a bad file leaves the cache as it was
+          raise ValueError('snapshot checksum mismatch')
+
+      self.clear()
+      if layout == self._layout() and [maxSize for maxSize, _ in lists] == [cachelist.maxSize for cachelist in self.hierarchy]:
+        with contextlib.ExitStack() as stack:  #same shape: relink every list head to tail in one pass
+          for lock in self.locks:
+            stack.enter_context(lock)
+          for cachelist, (_, records) in zip(self.hierarchy, lists):
+            for content, expires in records:
+              if expires is None or expires > now:
+                cachelist._link(content, expires, atTail=True)
+            cachelist.setPolicy(cachelist.policy)
+      else:  #different shape or routing: insert everything again, coldest first so recency survives, the last level is the coldest
+        for _, records in reversed(lists):
+          for content, expires in reversed(records):
+            if expires is None or expires > now:
+              with _ShardLock(self, content) as shard:
+                self._insert(self.shards[shard], content, None, expires)
+      return 'Cache loaded!'
+
+    def _reclaim(self, cachelist):
+      #run by the evictor: reclaim in rounds, letting go of the shard lock in between so inserts get in
+      evicted = 0
+      shard = next((shard for shard, chain in enumerate(self.shards) if any(level is cachelist for level in chain)), None)
+      while shard is not None:
+        locks = self.locks
+        if shard >= len(locks):
+          break  #resharded away
+        with locks[shard]:
+          if shard >= len(self.shards) or not any(level is cachelist for level in self.shards[shard]):
+            break  #resharded away in between
+          evicted += cachelist.reclaim(self.reclaimBatch)
+          if not cachelist.pressured:
+            break
+        time.sleep(0)  #hand the GIL over between rounds too, or a waiting insert can sit out a whole switch interval
+      return evicted
+
+    def reclaim(self):
+      '''
+        Run the evictor once on the calling thread, for Cache(background=False) or to catch up
+        right now. Returns how many items were evicted.
+
+        >>> cache = Cache(100, mode='exclusive', capacities=[100, 200], watermarks=(0.9, 0.6), background=False)
+        >>> for cid in range(10):
+        ...     _ = cache.insert(ContentItem(cid, 10, "Content-Type: 0", cid))
+        >>> cache.occupancy()[0]['bytes'], cache.reclaim(), [len(level) for level in cache.hierarchy]
+        (100, 4, [6, 4])
+      '''
+      return 0 if self.evictor is None else self.evictor.run()
+
+    def close(self):
+      #stop the evictor thread and delete the disk level, the memory levels keep working with put evicting inline
+      if self.evictor is not None:
+        self.evictor.stop()
+        self.watermarks = None  #lists made by a later reshard don't report to a stopped evictor either
+        for cachelist in self.hierarchy:
+          cachelist.onPressure = None
+      for cachelist in self.hierarchy:
+        if isinstance(cachelist, DiskCacheList):
+          cachelist.close()
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, *exc):
+      self.close()
+
+    def occupancy(self):
+      report = []  #one row per shard so we can see if the hash spreads the load
+      for shard, chain in enumerate(self.shards):
+        items = sum(len(cachelist) for cachelist in chain)
+        used = sum(cachelist.maxSize - cachelist.remainingSpace for cachelist in chain)
+        capacity = sum(cachelist.maxSize for cachelist in chain)
+        report.append({'shard': shard, 'items': items, 'bytes': used, 'fill': used / capacity if capacity else 0.0})
+      return report
+
+    def enableStats(self, latency=False):
+      #turn the counters on for every list, and the insert/get latency histograms with latency=True
+      self.instrumented = True
+      for cachelist in self.hierarchy:
+        cachelist.enableStats()
+      if latency and self.latency is None:
+        self.latency = {'insert': LatencyHistogram(), 'get': LatencyHistogram()}
+
+    def listen(self, event, callback):
+      #callback(cachelist, content) on every 'evict' and callback(cachelist, cid) on every 'miss', in every list
+      self.enableStats()
+      self.listeners.append((event, callback))
+      for cachelist in self.hierarchy:
+        cachelist.listen(event, callback)
+
+    def stats(self):
+      '''
+        Snapshot of the counters of every list plus the latency histograms. Turn them on with
+        Cache(stats=True, latency=True) or enableStats(); prometheus() renders the same snapshot.
+
+        >>> cache = Cache(20, mode='exclusive', stats=True, latency=True)
+        >>> evicted = []
+        >>> cache.listen('evict', lambda cachelist, content: evicted.append(content.cid))
+        >>> for cid in range(6):
+        ...     _ = cache.insert(ContentItem(cid, 10, "Content-Type: 0", cid))
+        >>> cache[ContentItem(0, 10, "", None)].value.cid, cache[ContentItem(9, 10, "", None)]
+        (0, 'Cache miss!')
+        >>> evicted
+        [0, 1, 2, 3, 4]
+        >>> snapshot = cache.stats()
+        >>> [(level['hits'], level['misses'], level['inserts'], level['evictions']) for level in snapshot['levels']]
+        [(0, 2, 7, {'lru': 5}), (1, 1, 5, {}), (0, 1, 0, {})]
+        >>> snapshot['latency']['insert']['count'], snapshot['latency']['get']['count']
+        (6, 2)
+        >>> [line for line in cache.prometheus().splitlines() if line.startswith('cache_hits_total')]
+        ['cache_hits_total{shard="0",level="1"} 0', 'cache_hits_total{shard="0",level="2"} 1', 'cache_hits_total{shard="0",level="3"} 0']
+      '''
+      levels = []
+      for shard, chain in enumerate(self.shards):
+        for level, cachelist in enumerate(chain):
+          row = {'shard': shard, 'level': level + 1, 'items': len(cachelist), 'bytes': cachelist.maxSize - cachelist.remainingSpace, 'capacity': cachelist.maxSize}
+          if cachelist.stats is not None:
+            row.update(cachelist.stats.snapshot())
+          levels.append(row)
+      latency = {}
+      if self.latency is not None:
+        for operation, histogram in self.latency.items():
+          latency[operation] = {'count': histogram.count, 'sum ns': histogram.total, 'buckets': list(histogram.buckets),
+                                'p50 ns': histogram.percentile(0.5), 'p99 ns': histogram.percentile(0.99), 'p999 ns': histogram.percentile(0.999)}
+      return {'levels': levels, 'latency': latency}
+
+    def prometheus(self, snapshot=None):
+      #the stats() snapshot in the Prometheus text exposition format
+      snapshot = self.stats() if snapshot is None else snapshot
+      lines = []
+      metrics = (('cache_items', 'gauge', 'items', 'Items held by the list.'),
+                 ('cache_bytes', 'gauge', 'bytes', 'Bytes held by the list.'),
+                 ('cache_capacity_bytes', 'gauge', 'capacity', 'Capacity of the list.'),
+                 ('cache_hits_total', 'counter', 'hits', 'Lookups answered by the list.'),
+                 ('cache_misses_total', 'counter', 'misses', 'Lookups the list could not answer.'),
+                 ('cache_inserts_total', 'counter', 'inserts', 'Content linked into the list.'),
+                 ('cache_updates_total', 'counter', 'updates', 'Content replaced in place.'),
+                 ('cache_rejected_total', 'counter', 'rejected', 'Inserts refused as too big.'),
+                 ('cache_expired_total', 'counter', 'expired', 'Content dropped when its ttl ran out.'),
+                 ('cache_evicted_bytes_total', 'counter', 'evicted bytes', 'Bytes evicted from the list.'),
+                 ('cache_denied_total', 'counter', 'denied', 'Inserts turned away by the admission filter.'),
+                 ('cache_reclaimed_total', 'counter', 'reclaimed', 'Evictions made by the background evictor.'))
+      for metric, kind, key, description in metrics:
+        rows = [row for row in snapshot['levels'] if key in row]
+        if not rows:
+          continue
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for row in rows:
+          lines.append(f'{metric}{{shard="{row["shard"]}",level="{row["level"]}"}} {row[key]}')
+      rows = [(row, policy, count) for row in snapshot['levels'] for policy, count in row.get('evictions', {}).items()]
+      if rows:
+        lines.append('# HELP cache_evictions_total Evictions by the policy that picked the victim.')
+        lines.append('# TYPE cache_evictions_total counter')
+        for row, policy, count in rows:
+          lines.append(f'cache_evictions_total{{shard="{row["shard"]}",level="{row["level"]}",policy="{policy}"}} {count}')
+      if snapshot['latency']:
+        lines.append('# HELP cache_operation_latency_seconds Latency of insert and get.')
+        lines.append('# TYPE cache_operation_latency_seconds histogram')
+        for operation, histogram in snapshot['latency'].items():
+          seen = 0
+          last = max((bucket for bucket, count in enumerate(histogram['buckets']) if count), default=0)
+          for bucket in range(last + 1):
+            seen += histogram['buckets'][bucket]
+            lines.append(f'cache_operation_latency_seconds_bucket{{op="{operation}",le="{(1 << bucket) / 1e9:g}"}} {seen}')
+          lines.append(f'cache_operation_latency_seconds_bucket{{op="{operation}",le="+Inf"}} {histogram["count"]}')
+          lines.append(f'cache_operation_latency_seconds_sum{{op="{operation}"}} {histogram["sum ns"] / 1e9:g}')
+          lines.append(f'cache_operation_latency_seconds_count{{op="{operation}"}} {histogram["count"]}')
+      return '\n'.join(lines) + '\n'
+
+    def reshard(self, shards):
+      if self.legacy:
+        raise ValueError('the legacy 3 list cache is partitioned by header, pass shards= to make it reshardable')
+      with contextlib.ExitStack() as stack:  #moving keys touches every shard so hold every lock, always in shard order
+        for shard, lock in enumerate(self.locks):
+          stack.enter_context(lock)
+          self._drain(shard)
+        self.generation += 1
+        try:
+          return self._reshard(shards)
+        finally:
+          self.generation += 1
+
+    def _reshard(self, shards):
+      old = self.shards
+      if shards > len(old):  #jump hashing only moves keys into the new shards when growing
+        self.shards = old + [self._chain() if self.mode != 'partition' else [self._newList(self.capacities[0], policy, admission=self._admission(shard), compression=self._compression(shard))] for shard, policy in enumerate(self._policies(shards - len(old)), len(old))]
+      else:
+        self.shards = old[:shards]
+      for chain in old:
+        for level, cachelist in enumerate(chain):
+          current = cachelist.tail  #oldest first so recency order survives the move
+          while current is not None:
+            previous = current.previous
+            target = self._route(current.value)
+            if target is not chain:
+              expires = current.expires
+              content = cachelist.remove(current.value.cid)
+              target[level].put(content, expires=expires, admit=False)  #already admitted once, a move must not lose it
+            current = previous
+      for chain in old[shards:]:  #dropped shards are empty by now, let go of their segments and directories
+        for cachelist in chain:
+          if isinstance(cachelist, DiskCacheList):
+            cachelist.close()
+      self.hierarchy = [cachelist for chain in self.shards for cachelist in chain]
+      self.size = len(self.hierarchy)
+      self.locks = self.locks[:shards] + [self._lock() for _ in range(shards - len(self.locks))]
+      self.readBuffers = self.readBuffers[:shards] + [deque(maxlen=self.readBuffer) for _ in range(shards - len(self.readBuffers))]
+      return self.occupancy()
+
+
+    def insert(self, content, evictionPolicy=None):
+      start = None if self.latency is None else time.perf_counter_ns()
+      with _ShardLock(self, content) as shard:
+        self._drain(shard)
+        result = self._insert(self.shards[shard], content, evictionPolicy)
+      if start is not None:
+        self.latency['insert'].record(time.perf_counter_ns() - start)
+      return result
+
+    def _insert(self, chain, content, evictionPolicy, expires=None):
+      if self.mode == 'partition':
+        return chain[0].put(content, evictionPolicy, expires) # As gabriel mention we trying to get the proper Cahcelist index by hashing the content.__hash__() and use thar index to access self.hierarchy and apply put
+
+      for cachelist in chain:  #a tiered cache holds a cid at most once per level so check every level first
+        node = cachelist.index.get(content.cid)
+        if node is not None and cachelist.find(content.cid) is None:
+          cachelist.remove(content.cid)  #a stale copy doesn't block inserting fresh content
+        elif node is not None:
+          return f"Content {content.cid} already in cache, insertion not allowed"
+      levels = [cachelist for cachelist in chain if content.size <= cachelist.maxSize]
+      if not levels:
+        return "Insertion not allowed"
+      if self.mode == 'exclusive':
+        return levels[0].put(content, evictionPolicy, expires)  #new content goes to the fastest level it fits in and gets demoted from there
+      for cachelist in reversed(levels[1:]):  #inclusive keeps a copy in every lower level too, fill from the bottom up
+        result = cachelist.put(content, evictionPolicy, expires)
+        if not result.startswith('INSERTED'):  #turned away below means it can't go above either
+          return result
+      return levels[0].put(content, evictionPolicy, expires)
+
+    def insert_many(self, contents, evictionPolicy=None):
+      '''
+        Insert a batch. Items are grouped by shard and each shard is locked once for its part of the
+        batch. Returns what insert would have returned, in order. Duplicates are judged against the
+        cache as it was when the batch started.
+
+        >>> cache = Cache(100, mode='exclusive', shards=2)
+        >>> items = [ContentItem(cid, 10, "Content-Type: 0", cid) for cid in range(8)]
+        >>> cache.insert_many(items + [items[0], ContentItem(99, 1000, "Content-Type: 0", "too big")])[-3:]
+        ['INSERTED: CONTENT ID: 7 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 7', 'Content 0 already in cache, insertion not allowed', 'Insertion not allowed']
+        >>> [node if node == 'Cache miss!' else node.value.cid for node in cache.get_many([3, items[5], 42])]
+        [3, 5, 'Cache miss!']
+
+        Inclusive caches insert item by item, so a copy only goes in above once it made it in below.
+
+        >>> arc = Cache(100, policies='arc', mode='inclusive', shards=1, capacities=[30, 60])
+        >>> _ = arc.insert_many([ContentItem(0, 10, "Content-Type: 0", 0)])
+        >>> _ = arc[ContentItem(0, 10, "Content-Type: 0", 0)]
+        >>> _ = arc.insert_many([ContentItem(cid, 10, "Content-Type: 0", cid) for cid in range(10, 16)])
+        >>> _ = arc.insert_many([ContentItem(0, 10, "Content-Type: 0", 0)] + [ContentItem(cid, 20, "Content-Type: 0", cid) for cid in range(20, 24)])
+        >>> [sorted(cachelist.index) for cachelist in arc.hierarchy]
+        [[23], [21, 22, 23]]
+      '''
+      results = [None] * len(contents)
+      for shard, positions in self._batches(contents):
+        self._drain(shard)
+        chain = self.shards[shard]
+        if self.mode == 'partition':
+          for position, result in zip(positions, chain[0].put_many([contents[position] for position in positions], evictionPolicy)):
+            results[position] = result
+          continue
+        if self.mode == 'inclusive':  #a lower batch can evict or turn away a copy, the one above must go in only after it landed
+          for position in positions:
+            results[position] = self._insert(chain, contents[position], evictionPolicy)
+          continue
+
+        byLevel = {}  #level -> positions whose content goes in there
+        seen = set()
+        for position in positions:
+          content = contents[position]
+          levels = [level for level, cachelist in enumerate(chain) if content.size <= cachelist.maxSize]
+          duplicate = content.cid in seen
+          for cachelist in chain:  #same checks as insert: stale copies go, live ones block the insert
+            if cachelist.index.get(content.cid) is not None:
+              if cachelist.find(content.cid) is None:
+                cachelist.remove(content.cid)
+              else:
+                duplicate = True
+          if duplicate:
+            results[position] = f"Content {content.cid} already in cache, insertion not allowed"
+          elif not levels:
+            results[position] = "Insertion not allowed"
+          else:
+            seen.add(content.cid)
+            byLevel.setdefault(levels[0], []).append(position)  #exclusive: the fastest level it fits in, like insert
+        for level in sorted(byLevel, reverse=True):  #lower levels first so demotions from above land after the batch
+          batch = byLevel[level]
+          for position, result in zip(batch, chain[level].put_many([contents[position] for position in batch], evictionPolicy)):
+            results[position] = result
+      return results
+
+    def get_many(self, keys):
+      #look up a batch of ContentItems or cids, one lock per shard, results in the same order as keys
+      results = ["Cache miss!"] * len(keys)
+      probes = [(position, probe) for position, probe in enumerate(map(self._probe, keys)) if probe is not None]
+      for shard, batch in self._batches([probe for _, probe in probes]):
+        self._drain(shard)
+        chain = self.shards[shard]
+        for index in batch:
+          position, probe = probes[index]
+          results[position] = self._lookup(chain, probe)
+      return results
+
+    def _demote(self, chain, level, node):
+      content = node.value
+      if self.mode == 'inclusive':  #a lower level dropping content means the copies above it have to go too
+        for cachelist in chain[:level]:
+          cachelist.remove(content.cid)
+        return
+      for cachelist in chain[level + 1:]:  #exclusive: move it down instead of losing it
+        if isinstance(content, CompressedContentItem) and not isinstance(cachelist, CompressedCacheList):
+          content = content.materialize()  #a raw level is charged the declared size again
+        if content.size <= cachelist.maxSize and cachelist.admits(content):  #a level that turns it away is skipped
+          cachelist.put(content, expires=node.expires)
+          return
+
+    def _promote(self, chain, level, node):
+      content = node.value
+      expires = node.expires  #read it before the node leaves its level
+      if level > 0 and content.size <= chain[0].maxSize:
+        content = content.materialize()  #moving up off the disk level means holding the payload in memory again
+      top = chain[0]
+      if self.mode == 'exclusive':
+        admitted = top.admits(content)
+      else:  #inclusive needs every level above it to take the copy
+        admitted = all(cachelist.admits(content) for cachelist in chain[:level] if content.cid not in cachelist.index)
+      if level == 0 or content.size > top.maxSize or not admitted:  #already at the top, too big or not admitted, just count the hit where it is
+        chain[level]._touch(node)
+        return node
+      if self.mode == 'exclusive':
+        chain[level].remove(content.cid)  #exclusive levels never share content so take it out before moving it up
+      else:
+        for cachelist in chain[1:level + 1]:  #inclusive: refresh the lower copies and copy it into the levels above
+          lower = cachelist._node(content.cid)
+          if lower is not None:
+            cachelist._touch(lower)
+          elif content.size <= cachelist.maxSize:
+            cachelist.put(content, expires=expires)
+      top.put(content, expires=expires)
+      return top._node(content.cid)
 
     def __getitem__(self, content):
-      cachelist = self.hierarchy[content.__hash__()]# As gabriel mention we trying to get the proper Cahcelist index by hashing the content.__hash__() and use thar index to access self.hierarchy 
-      if CacheList.__contains__(cachelist, content.cid): #determine if the content is in the cachelist 
-          return cachelist.head.value #if it does return the Node object
+      if self.latency is None:
+        return self._get(content)
+      start = time.perf_counter_ns()
+      node = self._get(content)
+      self.latency['get'].record(time.perf_counter_ns() - start)
+      return node
+
+    def _get(self, content):
+      if self.concurrent and not self.compact:  #a compact slot can be freed and reused under a lock free reader, so those take the lock
+        generation = self.generation
+        shards, buffers, locks = self.shards, self.readBuffers, self.locks
+        if not generation & 1 and self.generation == generation:  #lock free only while no reshard is swapping these lists
+          node = self._unlockedGet(content, generation, shards, buffers, locks)
+          if node is not None:
+            return node
+      with _ShardLock(self, content) as shard:
+        self._drain(shard)
+        return self._lookup(self.shards[shard], content)
+
+    def _unlockedGet(self, content, generation, shards, buffers, locks):
+      #a hit in the top list only needs a dict lookup, the promotion is buffered. None sends the caller to the locked path
+      shard = self._shardOf(content, shards)
+      chain = shards[shard]
+      node = chain[0].find(content.cid)
+      if node is not None:
+        if chain[0].stats is not None:  #counted without the lock, under heavy contention a hit can go uncounted
+          chain[0].stats.hits += 1
+        if self.admitting:
+          self._recordAccess(chain, content.cid)
+        buffers[shard].append(node)  #a full buffer drops the oldest hit, recency is only sampled under load
+        if locks[shard].acquire(blocking=False):  #replay the buffer only if nobody else holds the shard
+          try:
+            if self.generation == generation:
+              self._drain(shard)
+          finally:
+            locks[shard].release()
+        return node
+      if self.mode == 'partition' and self.generation == generation:
+        if chain[0].stats is not None:
+          chain[0]._missed(content.cid)
+        if self.admitting:
+          self._recordAccess(chain, content.cid)
+        return "Cache miss!"
+      return None
+
+    def _recordAccess(self, chain, cid):
+      for cachelist in chain:  #every admission filter in the chain counts the request, whichever level answers it
+        if cachelist.admission is not None:
+          cachelist.admission.record(cid)
+
+    def _lookup(self, chain, content):
+      if self.mode != 'partition':
+        if self.admitting:
+          self._recordAccess(chain, content.cid)
+        for level, cachelist in enumerate(chain):  #look from the fastest level down
+          node = cachelist.find(content.cid)
+          if node is not None:
+            if cachelist.stats is not None:
+              cachelist.stats.hits += 1
+            return self._promote(chain, level, node)
+          if cachelist.stats is not None:  #every level passed on the way down missed
+            cachelist._missed(content.cid)
+        return "Cache miss!"
+
+      node = chain[0].get(content.cid) #one lookup that also moves the node to the head
+      if node is not None:
+          return node #if it does return the Node object
       else:
           return "Cache miss!"    #else return Cache miss!
 
     def __setitem__(self, cid, content):
+      #this __setitem__ is really similar to upate so we just let update find the node through the index and move it to the head
+      with _ShardLock(self, content) as shard:
+        self._drain(shard)
+        for cachelist in self.shards[shard]:  #in a tiered cache every level holding the cid gets the new content
+          if cachelist.find(content.cid) is not None:
+            cachelist.update(content.cid, content)
 
-      #this __setitem__ is really similar to upate but instead of using head we using self.head we using Cachelist.head
-      cachelist = self.hierarchy[content.__hash__()]#we trying to get the proper Cahcelist index by hashing the content.__hash__() and use thar index to access self.hierarchy
-      head = cachelist.head #we set this variable to the head of the cachelist
+    def remove(self, key):
+      #take a ContentItem or cid out of every level that holds it, returns the content it had or None
+      probe = self._probe(key)
+      if probe is None:
+        return None
+      removed = None
+      with _ShardLock(self, probe) as shard:
+        self._drain(shard)
+        for cachelist in self.shards[shard]:
+          content = cachelist.remove(probe.cid)
+          if removed is None:
+            removed = content
+      return removed
 
-      while head is not None: #we iterate through the cachelist until we find the cid
-        if head.value.cid == content.cid:#check if the cid is the same
-          previous_size = head.value.size  #set the previous content to the size of the content
-          if content.size <= cachelist.remainingSpace + previous_size: #make sure the content size is less than our remaining space and previous size
-            if cachelist.maxSize >= cachelist.remainingSpace + previous_size - content.size: #make sure we don't go over maxSize
-              cachelist.remainingSpace += previous_size - content.size #update the remaining space
-              head.value = content #set this to the content the value of head so we can put it in update
+    def _probe(self, key):
+      if isinstance(key, ContentItem):
+        return key
+      if self.legacy:  #the legacy lists are picked by header so find the list that has the cid
+        for cachelist in self.hierarchy:
+          node = cachelist._node(key)
+          if node is not None:
+            return ContentItem(key, 0, node.value.header, None)  #routed by header, a stored item may hash by identity
+        return None
+      return ContentItem(key, 0, "", None)  #only the cid is needed to route
 
-                    
-              cachelist.update(head.value.cid, head.value) # use this function we written before to update the cachelist instead of writing the same thing
+    def _cached(self, key):
+      probe = self._probe(key)
+      if probe is None:
+        return None
+      node = self[probe]
+      return None if node == "Cache miss!" else node.value
 
-                    
-                
-        head = head.next #update the head
-      
+    def _checkFailure(self, cid):
+      failure = self.failures.get(cid)
+      if failure is not None:
+        if failure[0] > self.clock():
+          raise failure[1]  #still negatively cached, don't hit the origin again
+        self.failures.pop(cid, None)
 
-      
-    
\ No newline at end of file
+    def _loaded(self, cid, content, evictionPolicy):
+      self.failures.pop(cid, None)
+      self.insert(content, evictionPolicy)  #loads go through the normal insert path
+      return content
+
+    def _failed(self, cid, error, negativeTtl):
+      ttl = self.negativeTtl if negativeTtl is None else negativeTtl
+      if ttl:
+        now = self.clock()
+        with self.loadLock:
+          self.failures[cid] = (now + ttl, error)
+          if len(self.failures) >= self.failureLimit:  #failures for cids nobody asks for again would pile up forever
+            self.failures = {key: failure for key, failure in self.failures.items() if failure[0] > now}
+            self.failureLimit = max(64, 2 * len(self.failures))
+
+    def get_or_load(self, key, loader, evictionPolicy=None, negativeTtl=None):
+      '''
+        Read-through lookup: return the cached ContentItem for key (a ContentItem or a cid), or call
+        loader(cid) once, insert what it returns and hand it to every caller that missed meanwhile.
+
+        >>> cache = Cache(100, shards=2, negativeTtl=60)
+        >>> calls = []
+        >>> def slow(cid):
+        ...     calls.append(cid)
+        ...     time.sleep(0.05)
+        ...     return ContentItem(cid, 10, "Content-Type: 0", "origin")
+        >>> results = []
+        >>> workers = [threading.Thread(target=lambda: results.append(cache.get_or_load(7, slow))) for _ in range(8)]
+        >>> for thread in workers:
+        ...     thread.start()
+        >>> for thread in workers:
+        ...     thread.join()
+        >>> calls, len(results), cache.get_or_load(7, slow) is results[0]
+        ([7], 8, True)
+        >>> def broken(cid):
+        ...     calls.append(cid)
+        ...     raise OSError('origin down')
+        >>> cache.get_or_load(8, broken)
+        Traceback (most recent call last):
+        ...
+        OSError: origin down
+        >>> cache.get_or_load(8, broken)
+        Traceback (most recent call last):
+        ...
+        OSError: origin down
+        >>> calls
+        [7, 8]
+        >>> now = [0.0]
+        >>> flaky = Cache(100, shards=2, negativeTtl=10, clock=lambda: now[0])
+        >>> def down(cid):
+        ...     raise OSError('origin down')
+        >>> for cid in range(100):
+        ...     try:
+        ...         flaky.get_or_load(cid, down)
+        ...     except OSError:
+        ...         now[0] += 1
+        >>> len(flaky.failures) <= 64, 99 in flaky.failures, 0 in flaky.failures
+        (True, True, False)
+        >>> async def fetch(cid):
+        ...     calls.append(cid)
+        ...     await asyncio.sleep(0.01)
+        ...     return ContentItem(cid, 10, "Content-Type: 0", "async origin")
+        >>> async def many():
+        ...     return await asyncio.gather(*[cache.aget_or_load(9, fetch) for _ in range(5)])
+        >>> [item.content for item in asyncio.run(many())], calls
+        (['async origin', 'async origin', 'async origin', 'async origin', 'async origin'], [7, 8, 9])
+      '''
+      found = self._cached(key)
+      if found is not None:
+        return found
+      cid = key.cid if isinstance(key, ContentItem) else key
+
+      with self.loadLock:
+        self._checkFailure(cid)
+        future = self.inflight.get(cid)
+        leader = future is None  #the first caller loads, everyone else waits on its future
+        if leader:
+          future = self.inflight[cid] = concurrent.futures.Future()
+      if not leader:
+        return future.result()
+
+      try:
+        content = self._cached(key)  #someone may have finished loading it between our miss and taking the lead
+        if content is None:
+          content = self._loaded(cid, loader(cid), evictionPolicy)
+      except Exception as error:
+        self._failed(cid, error, negativeTtl)
+        future.set_exception(error)
+        raise
+      else:
+        future.set_result(content)
+        return content
+      finally:
+        with self.loadLock:
+          del self.inflight[cid]
+
+    async def aget_or_load(self, key, loader, evictionPolicy=None, negativeTtl=None):
+      #same as get_or_load for asyncio, loader may be a coroutine function or a plain one
+      found = self._cached(key)
+      if found is not None:
+        return found
+      cid = key.cid if isinstance(key, ContentItem) else key
+      self._checkFailure(cid)
+
+      future = self.asyncInflight.get(cid)
+      if future is not None:
+        return await asyncio.shield(future)  #a follower being cancelled must not cancel the shared load
+      future = self.asyncInflight[cid] = asyncio.get_running_loop().create_future()
+      try:
+        content = loader(cid)
+        if inspect.isawaitable(content):
+          content = await content
+        content = self._loaded(cid, content, evictionPolicy)
+      except asyncio.CancelledError:
+        future.cancel()
+        raise
+      except Exception as error:
+        self._failed(cid, error, negativeTtl)
+        future.set_exception(error)
+        future.exception()  #mark it retrieved so an unawaited follower doesn't log a warning
+        raise
+      else:
+        future.set_result(content)
+        return content
+      finally:
+        del self.asyncInflight[cid]
@@ -0,0 +1,241 @@
+import argparse
+import array
+import bisect
+import heapq
+import json
+import math
+
+from code import mix_hash
+from simulate import TRACES, replay, trace_arguments, zipf
+
+
+MODULUS = 1 << 24  #SHARDS samples a cid when mix_hash(cid) % MODULUS is under the threshold
+
+
+class _Fenwick:
+  #binary indexed tree over access times, each live cid keeps its weight at the time of its last access
+  def __init__(self, slots):
+    self.tree = array.array('d', bytes(8 * (slots + 1)))
+
+  def __len__(self):
+    return len(self.tree) - 1
+
+  def add(self, position, delta):
+    tree = self.tree
+    while position < len(tree):
+      tree[position] += delta
+      position += position & -position
+
+  def prefix(self, position):
+    total = 0.0
+    tree = self.tree
+    while position > 0:
+      total += tree[position]
+      position -= position & -position
+    return total
+
+
+class MissRatioCurve:
+  '''
+    LRU hit and miss ratios for every capacity at once, from the stack distances of a trace. A
+    request hits in an LRU of capacity c when the weight of the distinct cids used since its last
+    request, its own included, is at most c. Weights are sizes in the units Cache capacities are
+    given in, or 1 per cid with weighted=False. First requests never hit.
+
+    >>> trace = list(zipf(20000, 2000, seed=3))
+    >>> curve = analyze(trace)
+    >>> round(curve.hit_ratio(700), 3), round(replay(trace, 0, capacities=[700])['hit ratio'], 3), curve.capacity_for(0.8)
+    (0.8, 0.8, 697)
+    >>> advice = curve.recommend(1000, target=0.8)
+    >>> advice['capacities'], [round(ratio, 3) for ratio in advice['levels']]
+    ([125, 234, 338], [0.531, 0.163, 0.106])
+    >>> [round(level['hit ratio'], 3) for level in replay(trace, 0, capacities=advice['capacities'])['levels']]
+    [0.531, 0.163, 0.106]
+    >>> abs(analyze(trace, rate=0.1).hit_ratio(700) - curve.hit_ratio(700)) < 0.02
+    True
+  '''
+
+  def __init__(self, distances, requests, weighted=True, rate=1.0, adjust=0.0):
+    self.distances = sorted(distances)
+    self.adjust = adjust  #SHARDS-adj: a sample that caught more or fewer requests than its rate promises is off mostly in its hottest cids, so the difference counts as hits at the smallest distance
+    self.requests = requests + adjust  #requests the curve stands for, cold misses included
+    self.weighted = weighted
+    self.rate = rate  #the SHARDS sampling rate in effect at the end of the trace
+
+  def hits(self, capacities):
+    #how many requests hit at each capacity, a binary search over the sorted distances each
+    found = [bisect.bisect_right(self.distances, capacity) for capacity in capacities]
+    if not self.adjust:
+      return found
+    return [max(0.0, hits + self.adjust) if capacity > 0 else hits for capacity, hits in zip(capacities, found)]
+
+  def hit_ratio(self, capacity):
+    return self.hits([capacity])[0] / self.requests if self.requests else 0.0
+
+  def miss_ratio(self, capacity):
+    return 1.0 - self.hit_ratio(capacity)
+
+  def curve(self, capacities=None, points=64):
+    #(capacity, miss ratio) pairs, by default evenly spaced up to the capacity where every reuse hits
+    if capacities is None:
+      largest = self.distances[-1] if self.distances else 1
+      capacities = [max(1, round(largest * step / points)) for step in range(1, points + 1)]
+    return [(capacity, 1.0 - hits / self.requests if self.requests else 1.0) for capacity, hits in zip(capacities, self.hits(capacities))]
+
+  def capacity_for(self, hitRatio):
+    #the smallest capacity that reaches hitRatio, None when even an unbounded LRU can't
+    needed = math.ceil(hitRatio * self.requests - self.adjust)
+    if needed > len(self.distances):
+      return None
+    return math.ceil(self.distances[needed - 1]) if needed > 0 else (1 if hitRatio > 0 else 0)
+
+  def _knee(self, low, high, points=256):
+    #the capacity between low and high that sits furthest above the straight line between them
+    if high - low < 2:
+      return low
+    grid = sorted({low + (high - low) * step // points for step in range(1, points)})
+    hits = self.hits([low, high] + grid)
+    first, last, inside = hits[0], hits[1], hits[2:]
+    gains = [hit - first - (last - first) * (capacity - low) / (high - low) for capacity, hit in zip(grid, inside)]
+    return grid[max(range(len(grid)), key=gains.__getitem__)]
+
+  def _split(self, total, levels):
+    #cumulative level boundaries: each level ends at the knee of what is left of the curve
+    bounds = []
+    low = 0
+    for _ in range(levels - 1):
+      low = self._knee(low, total)
+      bounds.append(low)
+    return bounds + [total]
+
+  def recommend(self, budget, target=None, mode='exclusive', levels=3):
+    '''
+      Capacities for Cache(capacities=...) that fit in budget and reach target, or get as close
+      to it as the budget allows. With lru everywhere an exclusive chain behaves like one LRU as
+      big as all its levels, an inclusive one like its last level, and partition lists split the
+      keys so together they behave like one LRU as big as all of them.
+    '''
+    if mode not in ('partition', 'exclusive', 'inclusive'):
+      raise ValueError(f'Unknown cache mode {mode}')
+    needed = None if target is None else self.capacity_for(target)
+    if mode == 'inclusive':  #every level holds a copy of the ones above it, so the budget pays for the sum of the bounds
+      total = self._fit(budget, levels)
+    else:
+      total = budget
+    if needed is not None:
+      total = min(total, max(levels, needed))
+    if mode == 'partition':
+      capacities = [math.ceil(total / levels)] * levels
+      bounds = [total] * levels
+    else:
+      bounds = self._split(total, levels)
+      capacities = bounds if mode == 'inclusive' else [bound - previous for previous, bound in zip([0] + bounds, bounds)]
+    hits = self.hits(bounds)
+    ratios = [hit / self.requests if self.requests else 0.0 for hit in hits]
+    if mode == 'partition':
+      perLevel = [ratios[-1] / levels] * levels  #keys are hashed evenly over the lists
+    else:
+      perLevel = [ratio - previous for previous, ratio in zip([0.0] + ratios, ratios)]
+    return {'mode': mode, 'capacities': capacities, 'memory': sum(capacities), 'hit ratio': ratios[-1],
+            'levels': perLevel, 'target met': target is None or ratios[-1] >= target}
+
+  def _fit(self, budget, levels):
+    #the biggest last level whose nested upper levels still fit in budget alongside it
+    low, high = 0, budget
+    while low < high:
+      middle = (low + high + 1) // 2
+      if sum(self._split(middle, levels)) <= budget:
+        low = middle
+      else:
+        high = middle - 1
+    return low
+
+
+def analyze(trace, rate=1.0, maxKeys=None, weighted=True):
+  '''
+    Stack distances of (cid, size) requests in one pass, with a Fenwick tree over access times.
+    rate < 1 keeps only the cids whose hash falls under rate (SHARDS) and scales the distances
+    back up. maxKeys caps the cids tracked at once by lowering the rate whenever there are more,
+    so memory stays bounded on any trace.
+  '''
+  threshold = int(rate * MODULUS)
+  sampled = rate < 1.0 or maxKeys is not None
+  last = {}  #cid -> (time of its last request, weight it was counted with)
+  hashes = []  #(-hash, cid) of tracked cids, the largest hash on top for when the rate has to drop
+  tree = _Fenwick(1024)
+  live = 0.0  #total weight in the tree
+  clock = 0
+  requests = 0
+  distances = array.array('d')
+
+  expected = 0.0  #requests the sample should have had at the rates in effect, for the SHARDS adjustment
+  for cid, size in trace:
+    if sampled:
+      expected += threshold / MODULUS
+      hashed = mix_hash(cid) % MODULUS
+      if hashed >= threshold:
+        continue
+    requests += 1
+    weight = size if weighted else 1
+    clock += 1
+    if clock > len(tree):  #out of time slots: renumber the live cids from 1 in the same order
+      ordered = sorted(last.items(), key=lambda item: item[1][0])
+      tree = _Fenwick(max(1024, 2 * len(ordered)))
+      for position, (key, (_, counted)) in enumerate(ordered, 1):
+        last[key] = (position, counted)
+        tree.add(position, counted)
+      clock = len(ordered) + 1
+    previous = last.get(cid)
+    if previous is not None:
+      position, counted = previous
+      newer = live - tree.prefix(position)  #weight of the cids used after this one
+      distances.append((newer + weight) * MODULUS / threshold if sampled else newer + weight)
+      tree.add(position, -counted)
+      live -= counted
+    elif sampled:
+      heapq.heappush(hashes, (-hashed, cid))
+    last[cid] = (clock, weight)
+    tree.add(clock, weight)
+    live += weight
+
+    while maxKeys is not None and len(last) > maxKeys:  #SHARDS with a fixed size: drop the largest hash and sample below it
+      top = -hashes[0][0]
+      while hashes and -hashes[0][0] == top:
+        _, key = heapq.heappop(hashes)
+        position, counted = last.pop(key)
+        tree.add(position, -counted)
+        live -= counted
+      threshold = top
+
+  return MissRatioCurve(distances, requests, weighted, threshold / MODULUS if sampled else 1.0, expected - requests if sampled else 0.0)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='miss ratio curve of a trace and Cache capacities for a memory budget')
+  trace_arguments(parser)
+  parser.add_argument('--budget', type=int, required=True, help='total capacity to split over the levels, in the units of the trace sizes')
+  parser.add_argument('--target', type=float, help='hit ratio to reach with as little of the budget as possible')
+  parser.add_argument('--mode', default='exclusive', choices=['partition', 'exclusive', 'inclusive'])
+  parser.add_argument('--levels', type=int, default=3)
+  parser.add_argument('--rate', type=float, default=1.0, help='SHARDS sampling rate')
+  parser.add_argument('--max-keys', type=int, help='SHARDS fixed size: track at most this many cids')
+  parser.add_argument('--unweighted', action='store_true', help='count cids instead of summing their sizes')
+  parser.add_argument('--points', type=int, default=16)
+  parser.add_argument('--json', help='write the curve and the recommendation to this file')
+  args = parser.parse_args(argv)
+
+  curve = analyze(TRACES[args.trace](args), args.rate, args.max_keys, not args.unweighted)
+  points = curve.curve([max(1, args.budget * step // args.points) for step in range(1, args.points + 1)])
+  for capacity, miss in points:
+    print(f'{capacity:>12} miss {miss:.4f}')
+  advice = curve.recommend(args.budget, args.target, args.mode, args.levels)
+  print(f"capacities {advice['capacities']} memory {advice['memory']} hit {advice['hit ratio']:.4f} "
+        + ' '.join(f'L{level} {ratio:.4f}' for level, ratio in enumerate(advice['levels'], 1))
+        + ('' if advice['target met'] else ' target not reachable in budget'))
+  if args.json:
+    with open(args.json, 'w') as stream:
+      json.dump({'rate': curve.rate, 'requests': curve.requests, 'curve': points, 'recommendation': advice}, stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import time
+
+from code import Cache, ContentItem
+
+
+MONTH = 60 * 60 * 24 * 30  #memcached reads an exptime past this as a unix time instead of seconds from now
+STORAGE = ('set', 'add', 'replace')
+
+
+def _ttl(exptime):
+  if exptime == 0:
+    return None
+  if exptime > MONTH:
+    return exptime - time.time()
+  return exptime
+
+
+def _payload(content):
+  payload = content.content
+  if isinstance(payload, (bytes, bytearray, memoryview)):
+    return bytes(payload)
+  return str(payload).encode('utf-8')  #content cached from python code, not through the protocol
+
+
+class CacheServer:
+  '''
+    Serves a Cache over the memcached text protocol: get/gets with any number of keys, set, add,
+    replace, delete, flush_all, stats, version and quit. Commands on a connection are answered
+    in order as they are read, so a client can pipeline as many as it likes. Each connection
+    reads lines of at most maxLine bytes and values of at most maxValue, and writing to a
+    connection waits while more than outBuffer bytes are queued for it. The event loop is the
+    only thread touching the Cache, so it needs no locks.
+
+    >>> async def demo():
+    ...     server = CacheServer(Cache(1000, mode='exclusive', shards=2))
+    ...     await server.start('127.0.0.1', 0)
+    ...     client = CacheClient('127.0.0.1', server.port, pool=2)
+    ...     stored = [await client.set('page', b'<html>psu</html>', flags=2), await client.add('page', b'again')]
+    ...     many = await client.set_many({'a': b'1', 'b': b'22'})
+    ...     found = await client.get_many(['page', 'a', 'missing'])
+    ...     deleted = [await client.delete('a'), await client.delete('a')]
+    ...     after = await client.get('a')
+    ...     await client.close()
+    ...     await server.close()
+    ...     return stored, many, found, deleted, after
+    >>> asyncio.run(demo())
+    ([True, False], [True, True], {'page': (b'<html>psu</html>', 2), 'a': (b'1', 0)}, [True, False], None)
+    >>> async def malformed():
+    ...     server = CacheServer(Cache(1000, mode='exclusive', shards=2))
+    ...     await server.start('127.0.0.1', 0)
+    ...     reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+    ...     writer.write(b'get \\xff\\r\\nset \\xfe 0 0 1\\r\\nx\\r\\nget\\r\\nversion\\r\\n')
+    ...     replies = [await reader.readline() for _ in range(4)]
+    ...     writer.close()
+    ...     await server.close()
+    ...     return replies
+    >>> asyncio.run(malformed())
+    [b'CLIENT_ERROR bad key\\r\\n', b'CLIENT_ERROR bad key\\r\\n', b'ERROR\\r\\n', b'VERSION multi-level-cache\\r\\n']
+  '''
+
+  def __init__(self, cache, maxLine=2048, maxValue=1 << 20, outBuffer=1 << 18):
+    self.cache = cache
+    self.maxLine = maxLine
+    self.maxValue = maxValue
+    self.outBuffer = outBuffer
+    self.server = None
+    self.port = None
+    self.connections = 0
+    self.commands = 0
+
+  async def start(self, host='127.0.0.1', port=11211):
+    self.server = await asyncio.start_server(self._serve, host, port, limit=self.maxLine)
+    self.port = self.server.sockets[0].getsockname()[1]  #port 0 picks a free one
+    return self
+
+  async def serve_forever(self):
+    async with self.server:
+      await self.server.serve_forever()
+
+  async def close(self):
+    self.server.close()
+    await self.server.wait_closed()
+
+  async def _serve(self, reader, writer):
+    writer.transport.set_write_buffer_limits(high=self.outBuffer)
+    self.connections += 1
+    try:
+      while True:
+        try:
+          line = await reader.readuntil(b'\r\n')
+        except asyncio.LimitOverrunError:
+          writer.write(b'CLIENT_ERROR line too long\r\n')
+          break
+        except (asyncio.IncompleteReadError, ConnectionError):
+          break
+        self.commands += 1
+        if not await self._command(line[:-2].split(), reader, writer):
+          break
+        await writer.drain()  #only waits once the client falls outBuffer behind, a pipeline keeps flowing
+    finally:
+      self.connections -= 1
+      writer.close()
+
+  async def _command(self, words, reader, writer):
+    #answer one command, False closes the connection
+    if not words:
+      writer.write(b'ERROR\r\n')
+      return True
+    name = words[0].decode('ascii', 'replace')
+    try:
+      return await self._dispatch(name, words, reader, writer)
+    except UnicodeDecodeError:  #keys are utf-8 text to the Cache, anything else is the client's mistake
+      writer.write(b'CLIENT_ERROR bad key\r\n')
+      return True
+
+  async def _dispatch(self, name, words, reader, writer):
+    if name in ('get', 'gets') and len(words) >= 2:
+      self._get(words[1:], writer, name == 'gets')
+    elif name in STORAGE:
+      return await self._store(name, words, reader, writer)
+    elif name == 'delete' and len(words) >= 2:
+      found = self.cache.remove(words[1].decode('utf-8')) is not None
+      self._reply(writer, words, b'DELETED\r\n' if found else b'NOT_FOUND\r\n')
+    elif name == 'flush_all':
+      self.cache.clear()
+      self._reply(writer, words, b'OK\r\n')
+    elif name == 'stats':
+      items = sum(len(cachelist) for cachelist in self.cache.hierarchy)
+      used = sum(cachelist.maxSize - cachelist.remainingSpace for cachelist in self.cache.hierarchy)
+      writer.write(f'STAT curr_items {items}\r\nSTAT bytes {used}\r\nSTAT curr_connections {self.connections}\r\nSTAT cmd_total {self.commands}\r\nEND\r\n'.encode('ascii'))
+    elif name == 'version':
+      writer.write(b'VERSION multi-level-cache\r\n')
+    elif name == 'quit':
+      return False
+    else:
+      writer.write(b'ERROR\r\n')
+    return True
+
+  def _reply(self, writer, words, response):
+    if words[-1] != b'noreply':
+      writer.write(response)
+
+  def _get(self, keys, writer, cas):
+    cids = [key.decode('utf-8') for key in keys]
+    out = []
+    for key, found in zip(keys, self.cache.get_many(cids)):  #one batch lookup for every key on the line
+      if found == 'Cache miss!':
+        continue
+      content = found.value
+      data = _payload(content)
+      flags = content.header if content.header.isdigit() else '0'  #the header is the flags for anything set through the protocol
+      out.append(b'VALUE %s %s %d%s\r\n%s\r\n' % (key, flags.encode('ascii'), len(data), b' 0' if cas else b'', data))
+    out.append(b'END\r\n')
+    writer.write(b''.join(out))
+
+  async def _store(self, name, words, reader, writer):
+    try:
+      key, flags, exptime, length = words[1], int(words[2]), int(words[3]), int(words[4])
+    except (IndexError, ValueError):
+      writer.write(b'CLIENT_ERROR bad command line format\r\n')
+      return True
+    if length > self.maxValue:  #read it off the wire in pieces so one huge value can't pin a big buffer
+      remaining = length + 2
+      while remaining:
+        chunk = await reader.read(min(remaining, 1 << 16))
+        if not chunk:
+          return False
+        remaining -= len(chunk)
+      writer.write(b'SERVER_ERROR object too large for cache\r\n')
+      return True
+    try:
+      data = await reader.readexactly(length + 2)
+    except asyncio.IncompleteReadError:
+      return False
+    if data[-2:] != b'\r\n':
+      writer.write(b'CLIENT_ERROR bad data chunk\r\n')
+      return True
+
+    cid = key.decode('utf-8')
+    if name != 'add' and self.cache.remove(cid) is None and name == 'replace':  #set and replace overwrite, Cache.insert never does
+      self._reply(writer, words, b'NOT_STORED\r\n')
+      return True
+    if exptime < 0:  #already expired: memcached stores nothing and says it did
+      self._reply(writer, words, b'STORED\r\n')
+      return True
+    result = self.cache.insert(ContentItem(cid, length, str(flags), data[:-2], _ttl(exptime)))
+    if result.startswith('INSERTED'):
+      self._reply(writer, words, b'STORED\r\n')
+    elif result == 'Insertion not allowed':
+      self._reply(writer, words, b'SERVER_ERROR object too large for cache\r\n')
+    else:  #add of a cid that is there, or turned away by an admission filter
+      self._reply(writer, words, b'NOT_STORED\r\n')
+    return True
+
+
+class CacheClient:
+  '''
+    asyncio client for CacheServer, or any memcached. It keeps up to pool connections open and
+    every call borrows one. get_many sends all of its keys in get lines of at most batch keys.
+    set_many writes all of its sets before reading the replies. Values are bytes and come back
+    as (value, flags).
+  '''
+
+  def __init__(self, host='127.0.0.1', port=11211, pool=4, batch=100):
+    self.host = host
+    self.port = port
+    self.batch = batch
+    self.size = pool
+    self.opened = 0
+    self.idle = asyncio.LifoQueue()  #the most recently used connection goes out first, its buffers are warm
+
+  async def _acquire(self):
+    if self.idle.empty() and self.opened < self.size:
+      self.opened += 1
+      try:
+        return await asyncio.open_connection(self.host, self.port)
+      except OSError:
+        self.opened -= 1
+        raise
+    return await self.idle.get()
+
+  def _release(self, connection, healthy=True):
+    if healthy:
+      self.idle.put_nowait(connection)
+    else:  #a connection that failed mid reply is out of step with the server, drop it
+      self.opened -= 1
+      connection[1].close()
+
+  async def _call(self, request, replies):
+    connection = await self._acquire()
+    try:
+      connection[1].write(request)
+      result = await replies(connection[0])
+    except BaseException:
+      self._release(connection, healthy=False)
+      raise
+    self._release(connection)
+    return result
+
+  async def get(self, key):
+    found = await self.get_many([key])
+    return found.get(key)
+
+  async def get_many(self, keys):
+    lines = [b'get ' + b' '.join(key.encode('utf-8') for key in keys[start:start + self.batch]) + b'\r\n' for start in range(0, len(keys), self.batch)]
+
+    async def replies(reader):
+      found = {}
+      for _ in lines:
+        while True:
+          header = (await reader.readuntil(b'\r\n')).split()
+          if header[0] == b'END':
+            break
+          if header[0] != b'VALUE':
+            raise ConnectionError(b' '.join(header).decode('utf-8', 'replace'))
+          data = await reader.readexactly(int(header[3]) + 2)
+          found[header[1].decode('utf-8')] = (data[:-2], int(header[2]))
+      return found
+    return await self._call(b''.join(lines), replies)
+
+  def _storage(self, command, key, value, flags, ttl):
+    return b'%s %s %d %d %d\r\n%s\r\n' % (command, key.encode('utf-8'), flags, ttl, len(value), value)
+
+  async def set(self, key, value, flags=0, ttl=0):
+    return (await self._many(b'set', {key: value}, flags, ttl))[0]
+
+  async def add(self, key, value, flags=0, ttl=0):
+    return (await self._many(b'add', {key: value}, flags, ttl))[0]
+
+  async def set_many(self, items, flags=0, ttl=0):
+    return await self._many(b'set', items, flags, ttl)
+
+  async def _many(self, command, items, flags, ttl):
+    request = b''.join(self._storage(command, key, value, flags, ttl) for key, value in items.items())
+
+    async def replies(reader):
+      return [(await reader.readuntil(b'\r\n')) == b'STORED\r\n' for _ in items]
+    return await self._call(request, replies)
+
+  async def delete(self, key):
+    async def replies(reader):
+      return (await reader.readuntil(b'\r\n')) == b'DELETED\r\n'
+    return await self._call(b'delete %s\r\n' % key.encode('utf-8'), replies)
+
+  async def close(self):
+    while not self.idle.empty():
+      _, writer = self.idle.get_nowait()
+      writer.close()
+      await writer.wait_closed()
+    self.opened = 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='serve a Cache over the memcached text protocol')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=11211)
+  parser.add_argument('--capacity', type=int, default=64 << 20, help='lst_capacity of the Cache, in bytes')
+  parser.add_argument('--policy', default='lru')
+  parser.add_argument('--mode', default='exclusive', choices=['partition', 'exclusive', 'inclusive'])
+  parser.add_argument('--shards', type=int, default=8)
+  parser.add_argument('--max-value', type=int, default=1 << 20)
+  args = parser.parse_args(argv)
+
+  async def run():
+    server = await CacheServer(Cache(args.capacity, args.policy, mode=args.mode, shards=args.shards), maxValue=args.max_value).start(args.host, args.port)
+    print(f'serving on {args.host}:{server.port}')
+    await server.serve_forever()
+  asyncio.run(run())
+
+
+if __name__ == '__main__':
+  main()
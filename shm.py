@@ -0,0 +1,421 @@
+import array
+import math
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
+from code import ContentItem, Node, decode_payload, encode_payload, mix_hash
+
+
+#slots of the per shard counter array
+FIRST, LAST, FREE_ENTRY, FREE_BLOCK, FREE_BLOCKS, ITEMS, REMAINING, HITS, MISSES, EVICTIONS = range(10)
+
+#the per shard arrays, in the order they sit in the segment
+FIELDS = (
+  ('meta', 'q'),       #the counters above
+  ('buckets', 'i'),    #hash bucket -> first entry in its chain
+  ('hashes', 'Q'),     #entry -> mix_hash of its cid
+  ('chain', 'i'),      #entry -> next entry in the same bucket
+  ('prevs', 'i'),      #entry -> towards the most recently used end
+  ('nexts', 'i'),      #entry -> towards the least recently used end, also links the free entries
+  ('heads', 'i'),      #entry -> first block of its record
+  ('keyLens', 'i'),
+  ('headerLens', 'i'),
+  ('payloadLens', 'i'),
+  ('sizes', 'q'),      #entry -> the size the caller declared, what capacity is charged for
+  ('expiry', 'd'),     #entry -> time.time() it goes stale, nan never
+  ('kinds', 'B'),      #entry -> ord of the kind encode_payload gave its payload
+  ('links', 'i'),      #block -> next block of the same record, also links the free blocks
+)
+
+def _encodeKey(cid):
+  #a cid is compared byte for byte, the type goes in front so 1 and '1' stay different keys
+  if isinstance(cid, bool) or not isinstance(cid, (int, str, bytes)):
+    raise TypeError('SharedCache cids must be int, str or bytes')
+  if isinstance(cid, int):
+    return b'i%d' % cid
+  if isinstance(cid, str):
+    return b's' + cid.encode('utf-8')
+  return b'b' + cid
+
+
+def _decodeKey(key):
+  kind, body = key[:1], key[1:]
+  if kind == b'i':
+    return int(body)
+  return str(body, 'utf-8') if kind == b's' else body
+
+
+def _encode(content):
+  kind, data = encode_payload(content.materialize().content)
+  return ord(kind), bytes(data)
+
+
+def _counts(entries, blocks, blockSize):
+  table = 1 << max(0, entries - 1).bit_length()  #a power of two so a bucket is a mask away
+  counts = {name: entries for name, _ in FIELDS}
+  counts.update(meta=10, buckets=table, links=blocks)
+  return counts
+
+
+class SharedCache:
+  '''
+    LRU cache that lives in one multiprocessing.shared_memory segment, so every process that has
+    it sees the same content. The segment holds one region per shard: a chained hash table, the
+    recency list and an arena of fixed size blocks for the records, all as parallel arrays indexed
+    by entry number like CompactCacheList. A record is the encoded cid, header and payload spread
+    over a chain of blocks. Each shard has its own multiprocessing.Lock, so writers on different
+    shards don't wait on each other.
+
+    capacity is the declared size each shard may hold, like lst_capacity of one CacheList, and
+    arena is the bytes each shard keeps for records, capacity by default. A hit copies the record
+    out under the lock and decodes it after. str and bytes payloads are never pickled.
+    cache[content] answers like Cache, with a Node holding a copy of the item or 'Cache miss!',
+    and get(cid) hands back the ContentItem copy itself. Changing the copy doesn't change what is
+    cached.
+
+    Make it in the parent before the workers fork or hand it to multiprocessing.Process as an
+    argument, context being the start method of those workers. Workers call close() when they are done and the owner calls unlink() at the end.
+
+    >>> cache = SharedCache(100, shards=2, arena=256, blockSize=16)
+    >>> cache.insert(ContentItem(1000, 10, "Content-Type: 0", "0xA"))
+    'INSERTED: CONTENT ID: 1000 SIZE: 10 HEADER: Content-Type: 0 CONTENT: 0xA'
+    >>> cache.insert(ContentItem('home', 40, "Content-Type: 2", "<html><p>'CMPSC132'</p></html>"))
+    "INSERTED: CONTENT ID: home SIZE: 40 HEADER: Content-Type: 2 CONTENT: <html><p>'CMPSC132'</p></html>"
+    >>> cache.insert(ContentItem(1000, 10, "Content-Type: 0", "0xA"))
+    'Content 1000 already in cache, insertion not allowed'
+    >>> cache.insert(ContentItem(7, 101, "Content-Type: 1", "too big"))
+    'Insertion not allowed'
+    >>> cache[ContentItem('home', 40, "", None)].value
+    CONTENT ID: home SIZE: 40 HEADER: Content-Type: 2 CONTENT: <html><p>'CMPSC132'</p></html>
+    >>> worker = multiprocessing.get_context('fork').Process(target=lambda: cache.insert(ContentItem(5, 10, "Content-Type: 1", b"from a worker")))
+    >>> worker.start(); worker.join()
+    >>> cache[ContentItem(5, 10, "", None)].value.content, cache[ContentItem(6, 10, "", None)], cache.get(5).content
+    (b'from a worker', 'Cache miss!', b'from a worker')
+    >>> cache.remove('home').header, len(cache), cache.verify()
+    ('Content-Type: 2', 2, True)
+    >>> cache.unlink()
+  '''
+
+  def __init__(self, capacity, shards=4, arena=None, blockSize=128, ttl=None, name=None, context=None):
+    self.capacity = capacity
+    self.arena = capacity if arena is None else arena
+    self.blockSize = blockSize
+    self.ttl = ttl  #seconds for content without its own ttl, None keeps it until it is evicted
+    self.blocks = max(1, math.ceil(self.arena / blockSize))
+    self.entries = self.blocks  #a record takes at least one block, so there is never a use for more entries
+    self.numShards = shards
+    self.counts = _counts(self.entries, self.blocks, blockSize)
+    self.shardBytes = sum(self._span(name, code) for name, code in FIELDS) + self.blocks * blockSize
+    self.memory = shared_memory.SharedMemory(name=name, create=True, size=max(1, self.shardBytes * shards))
+    self.locks = [multiprocessing.get_context(context).Lock() for _ in range(shards)]  #context has to match how the workers start
+    self._map()
+    for shard in range(shards):
+      self._format(shard)
+
+  def _span(self, name, code):
+    return -(-self.counts[name] * struct.calcsize(code) // 8) * 8  #every array starts 8 byte aligned
+
+  def _map(self):
+    #cast views over the segment, one set per shard, nothing is copied
+    self.views = []
+    self.shards = []
+    for shard in range(self.numShards):
+      offset = shard * self.shardBytes
+      arrays = {}
+      for name, code in FIELDS:
+        raw = self.memory.buf[offset:offset + self.counts[name] * struct.calcsize(code)]
+        arrays[name] = raw.cast(code)
+        self.views.extend((raw, arrays[name]))
+        offset += self._span(name, code)
+      arrays['data'] = self.memory.buf[offset:offset + self.blocks * self.blockSize]
+      self.views.append(arrays['data'])
+      self.shards.append(arrays)
+
+  def _format(self, shard):
+    arrays = self.shards[shard]
+    arrays['buckets'][:] = array.array('i', [-1]) * self.counts['buckets']  #no chains yet
+    arrays['nexts'][:] = array.array('i', range(1, self.entries + 1))  #every entry and every block starts on its free list
+    arrays['nexts'][self.entries - 1] = -1
+    arrays['links'][:] = array.array('i', range(1, self.blocks + 1))
+    arrays['links'][self.blocks - 1] = -1
+    meta = arrays['meta']
+    meta[FIRST] = meta[LAST] = -1
+    meta[FREE_ENTRY] = meta[FREE_BLOCK] = 0
+    meta[FREE_BLOCKS] = self.blocks
+    meta[ITEMS] = meta[HITS] = meta[MISSES] = meta[EVICTIONS] = 0
+    meta[REMAINING] = self.capacity
+
+  def __getstate__(self):
+    #the segment travels by name and the locks the way multiprocessing passes them, so this only works while starting a worker
+    state = {key: value for key, value in self.__dict__.items() if key not in ('memory', 'views', 'shards')}
+    state['name'] = self.memory.name
+    return state
+
+  def __setstate__(self, state):
+    name = state.pop('name')
+    self.__dict__.update(state)
+    self.memory = shared_memory.SharedMemory(name=name)  #workers share the resource tracker of the parent, it unlinks nothing before the owner does
+    self._map()
+
+  def close(self):
+    for view in reversed(self.views):  #the segment can't be closed while a cast view still points into it
+      view.release()
+    self.views = []
+    self.shards = []
+    self.memory.close()
+
+  def unlink(self):
+    #close and destroy the segment, only the process that made it should do this, after everybody else closed
+    if self.views:
+      self.close()
+    self.memory.unlink()
+
+  def _shardOf(self, cid):
+    hashed = mix_hash(cid)
+    return hashed, (hashed >> 32) % self.numShards  #high bits pick the shard, low bits the bucket in it; the shard count never changes so no jump hash
+
+  def _find(self, arrays, hashed, key):
+    entry = arrays['buckets'][hashed & (self.counts['buckets'] - 1)]
+    hashes, keyLens, chain, heads, data, size = arrays['hashes'], arrays['keyLens'], arrays['chain'], arrays['heads'], arrays['data'], self.blockSize
+    length = len(key)
+    while entry >= 0:
+      if hashes[entry] == hashed and keyLens[entry] == length:
+        start = heads[entry] * size
+        if (data[start:start + length] if length <= size else self._read(arrays, entry, length)) == key:  #compared in place, nothing copied
+          return entry
+      entry = chain[entry]
+    return -1
+
+  def _read(self, arrays, entry, length):
+    #copy the first length bytes of the record of entry out of its blocks
+    data, links, size = arrays['data'], arrays['links'], self.blockSize
+    block = arrays['heads'][entry]
+    if length <= size:
+      return bytes(data[block * size:block * size + length])
+    parts = []
+    while length > 0:
+      parts.append(data[block * size:block * size + min(size, length)])
+      length -= size
+      block = links[block]
+    return b''.join(parts)
+
+  def _write(self, arrays, entry, record):
+    data, links, meta, size = arrays['data'], arrays['links'], arrays['meta'], self.blockSize
+    previous = -1
+    for offset in range(0, len(record), size):  #take blocks off the free list, they stay chained in that order
+      block = meta[FREE_BLOCK]
+      meta[FREE_BLOCK] = links[block]
+      if previous < 0:
+        arrays['heads'][entry] = block
+      else:
+        links[previous] = block
+      piece = record[offset:offset + size]
+      data[block * size:block * size + len(piece)] = piece
+      previous = block
+    links[previous] = -1
+    meta[FREE_BLOCKS] -= -(-len(record) // size)
+
+  def _splice(self, arrays, entry):
+    prevs, nexts, meta = arrays['prevs'], arrays['nexts'], arrays['meta']
+    previous, following = prevs[entry], nexts[entry]
+    if previous >= 0:
+      nexts[previous] = following
+    else:
+      meta[FIRST] = following
+    if following >= 0:
+      prevs[following] = previous
+    else:
+      meta[LAST] = previous
+
+  def _front(self, arrays, entry):
+    prevs, nexts, meta = arrays['prevs'], arrays['nexts'], arrays['meta']
+    first = meta[FIRST]
+    prevs[entry] = -1
+    nexts[entry] = first
+    if first >= 0:
+      prevs[first] = entry
+    else:
+      meta[LAST] = entry
+    meta[FIRST] = entry
+
+  def _drop(self, arrays, entry):
+    #unlink entry from its bucket and the recency list and give its blocks and the entry back
+    meta, chain = arrays['meta'], arrays['chain']
+    bucket = arrays['hashes'][entry] & (self.counts['buckets'] - 1)
+    current, previous = arrays['buckets'][bucket], -1
+    while current != entry:
+      previous, current = current, chain[current]
+    if previous < 0:
+      arrays['buckets'][bucket] = chain[entry]
+    else:
+      chain[previous] = chain[entry]
+    self._splice(arrays, entry)
+
+    block, links, freed = arrays['heads'][entry], arrays['links'], 1
+    while links[block] >= 0:  #the whole chain goes back at once, its last block points at the old free list
+      block = links[block]
+      freed += 1
+    links[block] = meta[FREE_BLOCK]
+    meta[FREE_BLOCK] = arrays['heads'][entry]
+    meta[FREE_BLOCKS] += freed
+    arrays['nexts'][entry] = meta[FREE_ENTRY]
+    meta[FREE_ENTRY] = entry
+    meta[ITEMS] -= 1
+    meta[REMAINING] += arrays['sizes'][entry]
+
+  def _stale(self, arrays, entry):
+    expires = arrays['expiry'][entry]
+    return not math.isnan(expires) and expires <= time.time()  #wall clock, every process has to agree on it
+
+  def _content(self, arrays, entry, cid):
+    #copy the header and payload out, the caller holds the lock and decodes once it let go
+    keyLen, headerLen, payloadLen = arrays['keyLens'][entry], arrays['headerLens'][entry], arrays['payloadLens'][entry]
+    record = self._read(arrays, entry, keyLen + headerLen + payloadLen)
+    ttl = arrays['expiry'][entry]
+    return cid, arrays['sizes'][entry], record[keyLen:keyLen + headerLen], arrays['kinds'][entry], record[keyLen + headerLen:], ttl
+
+  def _decode(self, copied):
+    cid, size, header, kind, payload, expires = copied
+    ttl = None if math.isnan(expires) else max(0.0, expires - time.time())
+    return ContentItem(cid, size, str(header, 'utf-8'), decode_payload(chr(kind), payload), ttl)
+
+  def __getitem__(self, content):
+    found = self.get(content.cid)
+    return found if isinstance(found, str) else Node(found)  #same shape as Cache.__getitem__
+
+  def get(self, cid):
+    key = _encodeKey(cid)
+    hashed, shard = self._shardOf(cid)
+    arrays = self.shards[shard]
+    with self.locks[shard]:
+      entry = self._find(arrays, hashed, key)
+      if entry >= 0 and self._stale(arrays, entry):
+        self._drop(arrays, entry)
+        entry = -1
+      if entry < 0:
+        arrays['meta'][MISSES] += 1
+        return 'Cache miss!'
+      arrays['meta'][HITS] += 1
+      self._splice(arrays, entry)
+      self._front(arrays, entry)
+      copied = self._content(arrays, entry, cid)
+    return self._decode(copied)  #unpickling happens outside the lock
+
+  def __contains__(self, cid):
+    key = _encodeKey(cid)
+    hashed, shard = self._shardOf(cid)
+    arrays = self.shards[shard]
+    with self.locks[shard]:
+      entry = self._find(arrays, hashed, key)
+      return entry >= 0 and not self._stale(arrays, entry)
+
+  def insert(self, content, evictionPolicy=None):
+    #evictionPolicy is only there so callers of Cache.insert work unchanged, the shared lists are always lru
+    key = _encodeKey(content.cid)
+    kind, payload = _encode(content)  #pickling happens outside the lock
+    header = content.header.encode('utf-8')
+    record = key + header + payload
+    blocks = -(-len(record) // self.blockSize)
+    if content.size > self.capacity or blocks > self.blocks:
+      return 'Insertion not allowed'
+    ttl = content.ttl if content.ttl is not None else self.ttl
+    expires = math.nan if ttl is None else time.time() + ttl
+
+    hashed, shard = self._shardOf(content.cid)
+    arrays = self.shards[shard]
+    meta = arrays['meta']
+    with self.locks[shard]:
+      entry = self._find(arrays, hashed, key)
+      if entry >= 0 and self._stale(arrays, entry):
+        self._drop(arrays, entry)
+      elif entry >= 0:
+        return f"Content {content.cid} already in cache, insertion not allowed"
+      while meta[REMAINING] < content.size or meta[FREE_BLOCKS] < blocks or meta[FREE_ENTRY] < 0:
+        self._drop(arrays, meta[LAST])  #evict from the lru end until the record fits
+        meta[EVICTIONS] += 1
+
+      entry = meta[FREE_ENTRY]
+      meta[FREE_ENTRY] = arrays['nexts'][entry]
+      self._write(arrays, entry, record)
+      arrays['hashes'][entry] = hashed
+      arrays['keyLens'][entry] = len(key)
+      arrays['headerLens'][entry] = len(header)
+      arrays['payloadLens'][entry] = len(payload)
+      arrays['kinds'][entry] = kind
+      arrays['sizes'][entry] = content.size
+      arrays['expiry'][entry] = expires
+      bucket = hashed & (self.counts['buckets'] - 1)
+      arrays['chain'][entry] = arrays['buckets'][bucket]
+      arrays['buckets'][bucket] = entry
+      self._front(arrays, entry)
+      meta[ITEMS] += 1
+      meta[REMAINING] -= content.size
+    return f'INSERTED: {content}'
+
+  def remove(self, cid):
+    key = _encodeKey(cid)
+    hashed, shard = self._shardOf(cid)
+    arrays = self.shards[shard]
+    with self.locks[shard]:
+      entry = self._find(arrays, hashed, key)
+      if entry < 0:
+        return None
+      copied = self._content(arrays, entry, cid)
+      self._drop(arrays, entry)
+    return self._decode(copied)
+
+  def clear(self):
+    for shard in range(self.numShards):
+      with self.locks[shard]:
+        self._format(shard)
+    return 'Cache cleared!'
+
+  def __len__(self):
+    return sum(arrays['meta'][ITEMS] for arrays in self.shards)
+
+  def __str__(self):
+    shards = []
+    for shard, arrays in enumerate(self.shards):
+      with self.locks[shard]:  #a listing doesn't count as a hit or move anything
+        copied = []
+        entry = arrays['meta'][FIRST]
+        while entry >= 0:
+          copied.append(self._content(arrays, entry, _decodeKey(self._read(arrays, entry, arrays['keyLens'][entry]))))
+          entry = arrays['nexts'][entry]
+      shards.append(f'SHARD {shard}:\n' + ''.join(f'{self._decode(item)}\n' for item in copied))
+    return ''.join(shards)
+
+  __repr__ = __str__
+
+  def stats(self):
+    #the same rows as Cache.stats, one level per shard
+    levels = []
+    for shard, arrays in enumerate(self.shards):
+      meta = arrays['meta']
+      levels.append({'shard': shard, 'level': 1, 'items': meta[ITEMS], 'bytes': self.capacity - meta[REMAINING], 'capacity': self.capacity,
+                     'arena free': meta[FREE_BLOCKS] * self.blockSize, 'hits': meta[HITS], 'misses': meta[MISSES], 'evictions': {'lru': meta[EVICTIONS]}})
+    return {'levels': levels, 'latency': {}}
+
+  def verify(self):
+    #walk every shard and check the list, the buckets and both free lists add up
+    for shard, arrays in enumerate(self.shards):
+      with self.locks[shard]:
+        meta, nexts, prevs = arrays['meta'], arrays['nexts'], arrays['prevs']
+        count = used = blocks = 0
+        previous, entry = -1, meta[FIRST]
+        while entry >= 0:
+          if prevs[entry] != previous or self._find(arrays, arrays['hashes'][entry], self._read(arrays, entry, arrays['keyLens'][entry])) != entry:
+            return False
+          count += 1
+          used += arrays['sizes'][entry]
+          blocks += -(-(arrays['keyLens'][entry] + arrays['headerLens'][entry] + arrays['payloadLens'][entry]) // self.blockSize)
+          previous, entry = entry, nexts[entry]
+        free, block = 0, meta[FREE_BLOCK]
+        while block >= 0:
+          free += 1
+          block = arrays['links'][block]
+        if previous != meta[LAST] or count != meta[ITEMS] or used != self.capacity - meta[REMAINING] or free != meta[FREE_BLOCKS] or blocks + free != self.blocks:
+          return False
+    return True
@@ -0,0 +1,204 @@
+import argparse
+import csv
+import itertools
+import json
+import random
+import time
+
+from code import Cache, ContentItem
+
+
+def read_csv(path):
+  #one request per row: cid,size (a header row is skipped, a missing size counts as 1)
+  with open(path, newline='') as stream:
+    for row in csv.reader(stream):
+      if not row or row[0].startswith('#'):
+        continue
+      try:
+        cid = int(row[0])
+      except ValueError:
+        if row[0].strip().lower() == 'cid':
+          continue
+        cid = row[0].strip()
+      yield cid, int(row[1]) if len(row) > 1 and row[1].strip() else 1
+
+
+def read_arc(path, blockSize=1):
+  #ARC traces (Megiddo and Modha): "start_block block_count ignored request_number", every block is a request
+  with open(path) as stream:
+    for line in stream:
+      fields = line.split()
+      if len(fields) < 2:
+        continue
+      start, count = int(fields[0]), int(fields[1])
+      for block in range(start, start + count):
+        yield block, blockSize
+
+
+def read_lirs(path, blockSize=1):
+  #LIRS traces: one block number per line, '*' lines separate phases
+  with open(path) as stream:
+    for line in stream:
+      line = line.strip()
+      if line and line != '*':
+        yield int(line), blockSize
+
+
+def zipf(requests, keys, alpha=0.99, seed=0, sizes=(1, 1)):
+  '''
+    Zipf distributed cids over range(keys), each cid keeps one size drawn from sizes.
+
+    >>> from collections import Counter
+    >>> trace = list(zipf(10000, 1000, seed=1))
+    >>> Counter(cid for cid, _ in trace).most_common(3)
+    [(0, 1251), (1, 669), (2, 472)]
+  '''
+  rng = random.Random(seed)
+  weights = list(itertools.accumulate(1 / (rank + 1) ** alpha for rank in range(keys)))
+  sizeOf = [rng.randint(*sizes) for _ in range(keys)]
+  for cid in rng.choices(range(keys), cum_weights=weights, k=requests):
+    yield cid, sizeOf[cid]
+
+
+def scan(requests, keys, start=0, size=1):
+  #every cid once in order, the pattern that flushes an LRU
+  for request in range(requests):
+    yield start + request % keys, size
+
+
+def loop(requests, keys, size=1):
+  #the same keys over and over, LRU misses every time once keys is bigger than the cache
+  return scan(requests, keys, 0, size)
+
+
+def mixed(requests, keys, scanEvery=10, seed=0):
+  #zipf traffic with a one-off scan over fresh cids woven in every scanEvery requests
+  scans = scan(requests, requests, keys)
+  for position, request in enumerate(zipf(requests, keys, seed=seed)):
+    yield next(scans) if position % scanEvery == scanEvery - 1 else request
+
+
+def percentile(ordered, fraction):
+  if not ordered:
+    return 0
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _latency(samples):
+  ordered = sorted(samples)
+  return {'p50': percentile(ordered, 0.5), 'p99': percentile(ordered, 0.99), 'p999': percentile(ordered, 0.999)}
+
+
+def _describe(admission):
+  if isinstance(admission, list):
+    return [_describe(spec) for spec in admission]
+  return None if admission is None else str(admission)
+
+
+def replay(trace, capacity, policy='lru', mode='exclusive', shards=None, capacities=None, admission=None):
+  '''
+    Replay (cid, size) requests against a fresh Cache: look every cid up and insert it on a miss.
+    Hits are attributed to the list that held the cid, latencies are in nanoseconds.
+
+    >>> result = replay(zipf(20000, 2000, seed=3), 100, 'arc')
+    >>> result['requests'], round(result['hit ratio'], 3), [level['hits'] for level in result['levels']]
+    (20000, 0.808, [11559, 2267, 2331])
+    >>> sorted(result['levels'][0]['latency'])
+    ['p50', 'p99', 'p999']
+  '''
+  cache = Cache(capacity, policy, mode=mode, shards=shards, capacities=capacities, admission=admission)
+  lists = cache.hierarchy
+  position = {id(cachelist): number for number, cachelist in enumerate(lists)}
+  hits = [0] * len(lists)
+  byteHits = [0] * len(lists)
+  hitLatency = [[] for _ in lists]
+  missLatency = []
+  requests = totalBytes = 0
+  clock = time.perf_counter_ns
+
+  started = time.perf_counter()
+  for cid, size in trace:
+    requests += 1
+    totalBytes += size
+    item = ContentItem(cid, size, "trace", None)
+    holder = None
+    for cachelist in cache._route(item):  #find the serving list before the lookup moves it
+      if cachelist.find(cid) is not None:
+        holder = position[id(cachelist)]
+        break
+    start = clock()
+    found = cache[item]
+    if found == "Cache miss!":
+      cache.insert(item)
+      missLatency.append(clock() - start)
+    else:
+      elapsed = clock() - start
+      hits[holder] += 1
+      byteHits[holder] += size
+      hitLatency[holder].append(elapsed)
+  elapsed = time.perf_counter() - started
+
+  return {
+    'policy': str(policy),
+    'mode': mode,
+    'admission': _describe(admission),
+    'capacity': capacity,
+    'requests': requests,
+    'hit ratio': sum(hits) / requests if requests else 0.0,
+    'byte hit ratio': sum(byteHits) / totalBytes if totalBytes else 0.0,
+    'ops/sec': requests / elapsed if elapsed else 0.0,
+    'miss latency': _latency(missLatency),
+    'levels': [{'level': number, 'hits': hits[number], 'hit ratio': hits[number] / requests if requests else 0.0,
+                'byte hits': byteHits[number], 'latency': _latency(hitLatency[number])} for number in range(len(lists))],
+  }
+
+
+TRACES = {
+  'zipf': lambda args: zipf(args.requests, args.keys, args.alpha, args.seed, (args.min_size, args.max_size)),
+  'scan': lambda args: scan(args.requests, args.keys),
+  'loop': lambda args: loop(args.requests, args.keys),
+  'mixed': lambda args: mixed(args.requests, args.keys, seed=args.seed),
+  'csv': lambda args: read_csv(args.file),
+  'arc': lambda args: read_arc(args.file),
+  'lirs': lambda args: read_lirs(args.file),
+}
+
+
+def trace_arguments(parser):
+  #the options that pick and shape a trace, shared with mrc.py
+  parser.add_argument('trace', choices=sorted(TRACES))
+  parser.add_argument('--file', help='trace file for csv, arc and lirs')
+  parser.add_argument('--requests', type=int, default=100_000)
+  parser.add_argument('--keys', type=int, default=10_000)
+  parser.add_argument('--alpha', type=float, default=0.99)
+  parser.add_argument('--min-size', type=int, default=1)
+  parser.add_argument('--max-size', type=int, default=1)
+  parser.add_argument('--seed', type=int, default=0)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='replay a request trace against Cache and report hit ratios and latency')
+  trace_arguments(parser)
+  parser.add_argument('--policy', nargs='+', default=['lru'])
+  parser.add_argument('--capacity', type=int, nargs='+', default=[1000])
+  parser.add_argument('--mode', default='exclusive', choices=['partition', 'exclusive', 'inclusive'])
+  parser.add_argument('--shards', type=int)
+  parser.add_argument('--admission', nargs='+', choices=['none', 'tinylfu'], help='admission filter for every level, or one per level')
+  parser.add_argument('--json', help='write the results to this file')
+  args = parser.parse_args(argv)
+
+  admission = None if args.admission is None else [None if name == 'none' else name for name in args.admission]
+  results = []
+  for policy, capacity in itertools.product(args.policy, args.capacity):
+    result = replay(TRACES[args.trace](args), capacity, policy, args.mode, args.shards, admission=admission)
+    result['trace'] = args.trace if args.file is None else args.file
+    results.append(result)
+    print(f"{policy:>6} {capacity:>10} hit {result['hit ratio']:.4f} byte hit {result['byte hit ratio']:.4f} "
+          f"{result['ops/sec']:>10.0f} ops/sec " + ' '.join(f"L{level['level'] + 1} {level['hit ratio']:.4f} p99 {level['latency']['p99']}ns" for level in result['levels']))
+  if args.json:
+    with open(args.json, 'w') as stream:
+      json.dump(results, stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()